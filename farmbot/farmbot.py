@@ -1,7 +1,16 @@
-import paho.mqtt.client as mqtt
-from urllib.request import urlopen, Request
+# paho-mqtt and urllib.request are slow to import and are only needed
+# once a connection is made, so they are imported on first use. This
+# keeps short-lived scripts and `python -m farmbot` fast to start.
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+import heapq
+import itertools
 import json
-import uuid
+import sys
+import threading
+import time
+import weakref
 
 
 class OkResponse():
@@ -10,17 +19,617 @@ class OkResponse():
 
 
 class ErrorResponse():
-    def __init__(self, id, errors):
+    def __init__(self, id, errors, kinds=None):
         self.errors = errors
         self.id = id
+        # The `kind` of each node in the `rpc_error` body, in the same
+        # order as `errors` (usually "explanation").
+        self.kinds = kinds or ["explanation"] * len(errors)
+
+    def error_class(self):
+        """
+        The most specific `RpcError` subclass matching the messages.
+        """
+        text = " ".join(self.errors).lower()
+        for (error_class, keywords) in _error_keywords:
+            for keyword in keywords:
+                if keyword in text:
+                    return error_class
+        return RpcError
+
+    def exception(self):
+        return self.error_class()(self)
+
+
+class RpcError(Exception):
+    """
+    Raised by futures whose RPC was answered with an `rpc_error`.
+    Subclasses narrow down the cause, based on the error messages.
+    """
+
+    def __init__(self, response):
+        super().__init__("; ".join(response.errors) or response.id)
+        self.response = response
+
+
+class RpcTimeoutError(RpcError, TimeoutError):
+    """
+    The device (or its firmware) did not finish the command in time.
+    """
+
+
+class LockedError(RpcError):
+    """
+    The device is emergency locked.
+    """
+
+
+class FirmwareError(RpcError):
+    """
+    The microcontroller firmware failed, e.g. a stalled motor.
+    """
+
+
+class ValidationError(RpcError):
+    """
+    The device rejected the command's arguments.
+    """
+
+
+# Checked in order; the first match wins.
+_error_keywords = (
+    (LockedError, ("emergency lock", "e-stop", "estop", "locked")),
+    (RpcTimeoutError, ("timeout", "timed out")),
+    (FirmwareError, ("firmware", "stall", "movement failed",
+                     "arduino", "farmduino", "encoder")),
+    (ValidationError, ("invalid", "expected", "unknown",
+                       "required", "unsupported", "not a valid")),
+)
+_no_message = "No message provided"
+# Larger payloads are rejected without being parsed.
+_max_payload = 4 * 1024 * 1024
+
+
+def _settle(future, result=None, error=None):
+    """
+    Resolve a future unless it was already resolved or cancelled.
+    """
+    from concurrent.futures import InvalidStateError
+    if future.done():
+        return
+    try:
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+    except InvalidStateError:
+        pass  # Settled by another thread in the meantime.
+
+
+class Outbox():
+    """
+    A durable, SQLite backed record of outbound `rpc_request`s.
+
+    Commands sent while the broker is unreachable are stored instead
+    of being lost, then published in order after the next connect.
+    Entries are deleted when the device answers with `rpc_ok` or
+    `rpc_error`, and unanswered ones are dropped once `ttl` seconds have
+    passed. Because the record lives on disk, a process that restarts
+    after a crash re-sends unanswered commands (its owner's entries are
+    marked unsent when the file is opened) but never ones that completed.
+    Within one process, a command that was published is not published
+    again after a reconnect.
+
+    One outbox file can be shared by several bots. Processes that share
+    a file must each pass a different `owner` (stable across restarts):
+    an outbox only sees, re-sends and expires its owner's entries, so
+    opening the file never re-sends commands that another running
+    process has in flight.
+    """
+
+    def __init__(self, path, ttl=None, owner=""):
+        import sqlite3
+        self.path = path
+        self.ttl = ttl
+        self.owner = owner
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path,
+                                   check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                label TEXT NOT NULL UNIQUE,
+                channel TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                expires_at REAL,
+                sent INTEGER NOT NULL DEFAULT 0,
+                done INTEGER NOT NULL DEFAULT 0,
+                owner TEXT NOT NULL DEFAULT ''
+            )""")
+        columns = [row[1] for row in
+                   self._db.execute("PRAGMA table_info(outbox)")]
+        if "owner" not in columns:
+            # Written by an older version.
+            self._db.execute("ALTER TABLE outbox "
+                             "ADD COLUMN owner TEXT NOT NULL DEFAULT ''")
+        # Answered entries are deleted, but files written by older
+        # versions may still hold some.
+        self._db.execute("DELETE FROM outbox WHERE done = 1")
+        self._db.execute("UPDATE outbox SET sent = 0 WHERE owner = ?",
+                         (owner,))
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params)
+
+    def add(self, label, channel, payload):
+        now = time.time()
+        expires_at = None if self.ttl is None else now + self.ttl
+        self._execute("INSERT INTO outbox (label, channel, payload, "
+                      "created_at, expires_at, owner) "
+                      "VALUES (?, ?, ?, ?, ?, ?)",
+                      (label, channel, payload, now, expires_at, self.owner))
+
+    def claim(self, label):
+        """
+        Mark an entry as sent. Returns False if it was already sent, so
+        that a command is never published twice per connection.
+        """
+        cursor = self._execute("UPDATE outbox SET sent = 1 "
+                               "WHERE label = ? AND sent = 0 AND done = 0",
+                               (label,))
+        return cursor.rowcount == 1
+
+    def unclaim(self, label):
+        self._execute("UPDATE outbox SET sent = 0 WHERE label = ?",
+                      (label,))
+
+    def mark_done(self, label):
+        self._execute("DELETE FROM outbox WHERE label = ?", (label,))
+
+    def expire(self, channel):
+        """
+        Delete unanswered entries past their TTL and return their labels.
+        """
+        params = (channel, self.owner, time.time())
+        where = ("WHERE channel = ? AND owner = ? AND done = 0 "
+                 "AND expires_at <= ?")
+        with self._lock:
+            rows = self._db.execute("SELECT label FROM outbox " + where,
+                                    params).fetchall()
+            self._db.execute("DELETE FROM outbox " + where, params)
+        return [row[0] for row in rows]
+
+    def unsent(self, channel):
+        """
+        Returns (label, payload) pairs waiting to be sent, oldest first.
+        """
+        return self._execute("SELECT label, payload FROM outbox "
+                             "WHERE channel = ? AND owner = ? "
+                             "AND sent = 0 AND done = 0 "
+                             "ORDER BY seq", (channel, self.owner)).fetchall()
+
+    def unanswered(self, channel=None):
+        """
+        Returns the labels of entries that have not been answered yet.
+        """
+        if channel is None:
+            rows = self._execute("SELECT label FROM outbox "
+                                 "WHERE owner = ? AND done = 0 "
+                                 "ORDER BY seq", (self.owner,)).fetchall()
+        else:
+            rows = self._execute("SELECT label FROM outbox "
+                                 "WHERE channel = ? AND owner = ? "
+                                 "AND done = 0 ORDER BY seq",
+                                 (channel, self.owner)).fetchall()
+        return [row[0] for row in rows]
+
+    def close(self):
+        self._db.close()
+
+
+class CounterLabels():
+    """
+    Makes RPC labels from a random `prefix` and a counter, which is much
+    cheaper than a UUID. `key(label)` turns these labels back into the
+    counter value, so pending commands can be looked up by a small int.
+    A forked child process picks a new prefix.
+    """
+
+    def __init__(self):
+        self.reset()
+        _label_generators.add(self)
+
+    def reset(self):
+        import os
+        self.prefix = os.urandom(6).hex() + "."
+        self._length = len(self.prefix)
+        self._counter = itertools.count(1)
+
+    def __call__(self):
+        return self.prefix + str(next(self._counter))
+
+    def key(self, label):
+        if label.startswith(self.prefix):
+            digits = label[self._length:]
+            if digits.isdigit() and digits.isascii():
+                return int(digits)
+        return label
+
+
+def _uuid1_label():
+    import uuid
+    return str(uuid.uuid1())
+
+
+def _uuid4_label():
+    import uuid
+    return str(uuid.uuid4())
+
+
+def _same_label(label):
+    return label
+
+
+def _reset_labels():
+    for labels in list(_label_generators):
+        labels.reset()
+
+
+def _reset_labels_after_fork():
+    import os
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=_reset_labels)
+
+
+# Every CounterLabels, to give them new prefixes in a forked child. One
+# fork hook serves them all, so instances can still be garbage collected.
+_label_generators = weakref.WeakSet()
+_reset_labels_after_fork()
+# Shared by every connection in the process, so labels never repeat.
+_counter_labels = CounterLabels()
+
+
+class RateLimiter():
+    """
+    A token bucket that lets `rate` messages per second through on
+    average, with bursts of up to `burst` messages (default: `rate`).
+    Give the same limiter to many bots (`ConnectionOptions(limiter=)`)
+    to limit them all together, or pass it as the `parent` of another
+    limiter to apply both limits.
+
+    The rate adapts to the broker: `backoff()` (called on unexpected
+    disconnects, and by `observe_latency()` when the broker takes longer
+    than `latency_target` seconds to acknowledge a publish) multiplies
+    the rate by
+    `backoff_factor`, at most once per `cooldown` seconds and down to
+    `min_rate`. The rate then recovers linearly, reaching `rate` again
+    after `recovery_time` seconds.
+
+    Counters: `acquired`, `waits` (acquires that had to wait), `waited`
+    (total seconds waited), `max_wait`, `timeouts` and `backoffs`.
+    """
+
+    def __init__(self,
+                 rate,
+                 burst=None,
+                 parent=None,
+                 min_rate=None,
+                 backoff_factor=0.5,
+                 recovery_time=30.0,
+                 latency_target=None,
+                 cooldown=1.0):
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.burst = float(burst or rate)
+        self.parent = parent
+        self.min_rate = min_rate or (self.max_rate / 10)
+        self.backoff_factor = backoff_factor
+        self.recovery_time = recovery_time
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+        self.tokens = self.burst
+        self._lock = threading.Lock()
+        self._updated_at = time.monotonic()
+        self._backoff_at = None
+        self.acquired = 0
+        self.waits = 0
+        self.waited = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+        self.backoffs = 0
+        # Runs publishes reserved from MQTT threads once they are due.
+        self.scheduler = _Scheduler()
+
+    def _refill(self, now):
+        elapsed = now - self._updated_at
+        if elapsed <= 0:
+            return
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate +
+                            elapsed * self.max_rate / self.recovery_time)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self._updated_at = now
+
+    def reserve(self, tokens=1, timeout=None):
+        """
+        Take `tokens` and return the number of seconds to wait before
+        using them, or None (taking nothing) if that is over `timeout`.
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            wait = 0.0
+            if self.tokens < tokens:
+                wait = (tokens - self.tokens) / self.rate
+            if timeout is not None and wait > timeout:
+                self.timeouts = self.timeouts + 1
+                return None
+            self.tokens = self.tokens - tokens
+        if self.parent is not None:
+            parent_wait = self.parent.reserve(tokens, timeout)
+            if parent_wait is None:
+                with self._lock:
+                    self.tokens = self.tokens + tokens
+                    self.timeouts = self.timeouts + 1
+                return None
+            wait = max(wait, parent_wait)
+        with self._lock:
+            self.acquired = self.acquired + 1
+            if wait > 0:
+                self.waits = self.waits + 1
+                self.waited = self.waited + wait
+                self.max_wait = max(self.max_wait, wait)
+        return wait
+
+    def acquire(self, tokens=1, timeout=None):
+        """
+        Block until `tokens` are available. Returns False, without
+        waiting, if that would take longer than `timeout` seconds.
+        """
+        wait = self.reserve(tokens, timeout)
+        if wait is None:
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    async def acquire_async(self, tokens=1, timeout=None):
+        """
+        Like `acquire()`, for asyncio code.
+        """
+        import asyncio
+        wait = self.reserve(tokens, timeout)
+        if wait is None:
+            return False
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return True
+
+    def backoff(self):
+        """
+        Slow down (see above). Also slows down the `parent`.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._backoff_at is None or \
+                    now - self._backoff_at >= self.cooldown:
+                self._refill(now)
+                self.rate = max(self.min_rate,
+                                self.rate * self.backoff_factor)
+                self._backoff_at = now
+                self.backoffs = self.backoffs + 1
+        if self.parent is not None:
+            self.parent.backoff()
+
+    def observe_latency(self, seconds):
+        """
+        Report how long the broker took to acknowledge a publish (from
+        publish to PUBACK, so only QoS 1+ publishes are measured).
+        """
+        if self.latency_target is not None and seconds > self.latency_target:
+            self.backoff()
+        elif self.parent is not None:
+            self.parent.observe_latency(seconds)
+
+
+class _Scheduler():
+    """
+    Calls functions at `time.monotonic()` deadlines, earliest first, on
+    a single daemon thread that is started when first needed. A heap of
+    pending calls replaces one `threading.Timer` thread per call.
+    """
+
+    def __init__(self):
+        # Heap of (due, sequence number, function, args).
+        self._queue = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._queue)
+
+    def call_later(self, delay, function, *args):
+        due = time.monotonic() + max(0.0, delay)
+        with self._cond:
+            heapq.heappush(self._queue,
+                           (due, next(self._sequence), function, args))
+            # Not alive in a forked child, or before the first call.
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._queue:
+                        self._cond.wait()
+                        continue
+                    wait = self._queue[0][0] - time.monotonic()
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                (_, _, function, args) = heapq.heappop(self._queue)
+            try:
+                function(*args)
+            except Exception:
+                # Report it like a Timer thread would, and keep going.
+                sys.excepthook(*sys.exc_info())
+
+
+class ConnectionOptions():
+    """
+    Settings for the MQTT connection of a `Farmbot`.
+
+      * transport: "tcp" (default) or "websockets". The WebSocket
+        transport connects to the token's `mqtt_ws` URL and uses TLS
+        when that URL starts with "wss".
+      * tls: Use TLS for the TCP transport (port 8883 by default).
+      * port: Override the default port.
+      * ca_certs: Path to a CA bundle for TLS. Defaults to the system
+        certificates.
+      * qos: Dict of channel name ("status", "logs", "from_device",
+        "sync", "from_clients") => QoS level. Unlisted channels use
+        QoS 0.
+      * clean_session: Set to False to keep a persistent session, so
+        that the broker queues QoS 1+ messages across short
+        disconnects. Requires a stable `client_id`, which defaults to
+        "farmbot_py_<bot>".
+      * client_id: MQTT client ID. Random when not set.
+      * keepalive: Seconds between keepalive pings.
+      * max_inflight: Maximum number of unacknowledged QoS 1+ messages.
+      * use_vhost: Prefix the username with the token's vhost.
+      * subscribe: The channels to subscribe to on connect, any of
+        "status", "logs", "from_device" and "sync". Defaults to all but
+        "sync".
+      * read_status_on_connect: Ask the device for a full status tree
+        when the connection is established.
+      * outbox: An `Outbox`. When set, commands issued while
+        disconnected are stored and sent after the next connect.
+      * rate_limit: Maximum commands per second for each bot. The bot
+        gets its own `RateLimiter`, whose parent is `limiter`.
+      * limiter: A `RateLimiter` shared by every bot using these
+        options (or given the same limiter). `send_rpc()` waits for it;
+        `emergency_lock()` never does.
+      * labels: How RPC labels are made. "counter" (default): a random
+        prefix, unique to this process, plus a counter. "uuid1" or
+        "uuid4": a UUID per command. Or a `CounterLabels`, or any
+        callable that returns a new, unique string.
+
+    See `ConnectionOptions.publish_only()` for write-only automation.
+    """
+    channel_names = ("status", "logs", "from_device", "sync")
+    default_channels = ("status", "logs", "from_device")
+    label_kinds = ("counter", "uuid1", "uuid4")
+
+    def __init__(self,
+                 transport="tcp",
+                 tls=False,
+                 port=None,
+                 ca_certs=None,
+                 qos=None,
+                 clean_session=True,
+                 client_id=None,
+                 keepalive=60,
+                 max_inflight=None,
+                 use_vhost=False,
+                 subscribe=default_channels,
+                 read_status_on_connect=True,
+                 outbox=None,
+                 rate_limit=None,
+                 limiter=None,
+                 labels="counter"):
+        if transport not in ("tcp", "websockets"):
+            raise ValueError("Unknown transport: " + str(transport))
+        for name in subscribe:
+            if name not in self.channel_names:
+                raise ValueError("Unknown channel: " + str(name))
+        if labels not in self.label_kinds and not callable(labels):
+            raise ValueError("Unknown labels: " + str(labels))
+        for (name, level) in (qos or {}).items():
+            if name not in self.channel_names + ("from_clients",):
+                raise ValueError("Unknown channel: " + str(name))
+            if not isinstance(level, int) or isinstance(level, bool) or \
+                    level not in (0, 1, 2):
+                raise ValueError("QoS must be 0, 1 or 2: " + repr(level))
+        self.transport = transport
+        self.tls = tls
+        self.port = port
+        self.ca_certs = ca_certs
+        self.qos = {"status": 0, "logs": 0, "from_device": 0, "sync": 0,
+                    "from_clients": 0}
+        self.qos.update(qos or {})
+        self.clean_session = clean_session
+        self.client_id = client_id
+        self.keepalive = keepalive
+        self.max_inflight = max_inflight
+        self.use_vhost = use_vhost
+        self.subscribe = tuple(subscribe)
+        self.read_status_on_connect = read_status_on_connect
+        self.outbox = outbox
+        self.rate_limit = rate_limit
+        self.limiter = limiter
+        self.labels = labels
+
+    @classmethod
+    def publish_only(cls, acks=False, **kwargs):
+        """
+        Options for write-only automation: no status or log
+        subscriptions and no `read_status` on connect, so the device
+        does not push state trees that would be thrown away. With
+        `acks=True`, only `from_device` is subscribed so that
+        `on_response` / `on_error` still fire.
+        """
+        subscribe = ("from_device",) if acks else ()
+        return cls(subscribe=subscribe,
+                   read_status_on_connect=False,
+                   **kwargs)
+
+    def new_client(self, bot):
+        client_id = self.client_id
+        if client_id is None and not self.clean_session:
+            client_id = "farmbot_py_" + bot.username
+        import paho.mqtt.client as mqtt
+        return mqtt.Client(client_id=client_id or "",
+                           clean_session=self.clean_session,
+                           transport=self.transport)
+
+    def username(self, bot):
+        vhost = getattr(bot, "vhost", None)
+        if self.use_vhost and vhost and vhost != "/":
+            return vhost + ":" + bot.username
+        return bot.username
+
+    def endpoint(self, bot):
+        """
+        Returns a (host, port, path, use_tls) tuple for the broker.
+        """
+        if self.transport == "websockets":
+            from urllib.parse import urlparse
+            url = urlparse(bot.mqtt_ws)
+            tls = self.tls or url.scheme == "wss"
+            port = self.port or url.port or (443 if tls else 80)
+            return (url.hostname, port, url.path or "/mqtt", tls)
+        port = self.port or (8883 if self.tls else 1883)
+        return (bot.hostname, port, None, self.tls)
 
 
 class FarmbotConnection():
-    def __init__(self, bot, mqtt=mqtt.Client()):
+    def __init__(self, bot, mqtt=None, options=None):
         self.bot = bot
-        self.mqtt = mqtt
+        self.options = options or ConnectionOptions()
+        # The MQTT client is created on first use (see `mqtt` below).
+        self._mqtt = None
+        if mqtt is not None:
+            self.mqtt = mqtt
         u = bot.username
-        self.mqtt.username_pw_set(u, bot.password)
         # bot/device_000/from_clients
         # bot/device_000/from_device
         # bot/device_000/logs
@@ -32,20 +641,110 @@ class FarmbotConnection():
         self.logs_chan = "bot/" + u + "/logs"
         self.incoming_chan = "bot/" + u + "/from_device"
         self.outgoing_chan = "bot/" + u + "/from_clients"
-        self.channels = (
-            self.status_chan,
-            self.logs_chan,
-            self.incoming_chan
-        )
+        self.sync_prefix = "bot/" + u + "/sync/"
+        self.sync_chan = self.sync_prefix + "#"
+        by_name = {"status": self.status_chan,
+                   "logs": self.logs_chan,
+                   "from_device": self.incoming_chan,
+                   "sync": self.sync_chan}
+        self.channels = tuple([by_name[name]
+                               for name in self.options.channel_names
+                               if name in self.options.subscribe])
+        qos = self.options.qos
+        self.channel_qos = {
+            self.status_chan: qos["status"],
+            self.logs_chan: qos["logs"],
+            self.incoming_chan: qos["from_device"],
+            self.sync_chan: qos["sync"],
+            self.outgoing_chan: qos["from_clients"],
+        }
+        labels = self.options.labels
+        if labels == "counter":
+            labels = _counter_labels
+        elif labels == "uuid1":
+            labels = _uuid1_label
+        elif labels == "uuid4":
+            labels = _uuid4_label
+        # () => new RPC label, and label => `pending` key.
+        self.new_label = labels
+        self.label_key = getattr(labels, "key", _same_label)
+        # The tables below are shared between the MQTT thread and the
+        # threads that send commands. They are copy-on-write: writers
+        # hold `_lock` and replace the whole table, so readers never
+        # lock and always see a complete table.
+        self._lock = threading.Lock()
+        # Label key => Future, resolved by `rpc_ok` / `rpc_error`. The
+        # exception to copy-on-write: it changes with every command, so
+        # it is modified in place (under `_lock`), and read only by
+        # `pop_pending()`.
+        self.pending = {}
+        # Pin number (as a string) => Futures waiting for a pin value.
+        self.pin_waiters = {}
+        # MoveFutures that are updated on every status message.
+        self.moves = []
+        # Callables that receive (kind, id, body) for each sync message.
+        self.sync_listeners = []
+        self.connected = False
+        # True from connect until stored commands were replayed.
+        self.replaying = False
+        self._outbox_lock = threading.Lock()
+        self._next_expiry = 0.0
+        # Number of malformed messages that were dropped.
+        self.rejected = 0
+        # Seconds from `emergency_lock()` to its `rpc_ok`, newest last.
+        self.lock_latencies = deque(maxlen=100)
+        self.aggregator = None
+        self.state_table = None
+        self.limiter = self.options.limiter
+        if self.options.rate_limit:
+            self.limiter = RateLimiter(self.options.rate_limit,
+                                       parent=self.options.limiter)
+        # MQTT message ID => publish time and PUBACK time, for
+        # `RateLimiter.observe_latency()`. The PUBACK can arrive before
+        # `publish()` returns the message ID, hence both tables.
+        self.sent_at = _BoundedDict(10000)
+        self.acked_at = _BoundedDict(10000)
+        # The thread running the MQTT loop, which must never block.
+        self.network_thread = None
+        # Job name => latest `JobProgress`, from the `jobs` subtree.
+        self.jobs = {}
+        self._raw_jobs = {}
+        # Callables that receive a `JobProgress` whenever a job changes.
+        self.job_listeners = []
+
+    @property
+    def mqtt(self):
+        if self._mqtt is None:
+            with self._lock:
+                if self._mqtt is None:
+                    self.mqtt = self.options.new_client(self.bot)
+        return self._mqtt
+
+    @mqtt.setter
+    def mqtt(self, client):
+        client.username_pw_set(self.options.username(self.bot),
+                               self.bot.password)
+        self._mqtt = client
 
     def start_connection(self):
         # Attach event handlers:
         self.mqtt.on_connect = self.handle_connect
         self.mqtt.on_message = self.handle_message
+        self.mqtt.on_disconnect = self.handle_disconnect
+        self.mqtt.on_publish = self.handle_publish
+
+        (host, port, path, tls) = self.options.endpoint(self.bot)
+        if tls:
+            self.mqtt.tls_set(ca_certs=self.options.ca_certs)
+        if path:
+            self.mqtt.ws_set_options(path=path)
+        if self.options.max_inflight is not None:
+            self.mqtt.max_inflight_messages_set(self.options.max_inflight)
 
         # Finally, connect to the server:
-        self.mqtt.connect(self.bot.hostname, 1883, 60)
+        self.mqtt.connect(host, port, self.options.keepalive)
 
+        self.network_thread = threading.current_thread()
         self.mqtt.loop_forever()
 
     def stop_connection(self):
@@ -53,10 +752,72 @@ class FarmbotConnection():
 
     def handle_connect(self, mqtt, userdata, flags, rc):
         for channel in self.channels:
-            mqtt.subscribe(channel)
-        self.bot.read_status()
+            mqtt.subscribe(channel, self.channel_qos[channel])
+        outbox = self.options.outbox
+        if outbox:
+            # New commands wait behind the stored ones until the replay
+            # is over (see `send_rpc()`).
+            self.replaying = True
+        self.connected = True
+        if outbox and self.limiter is not None:
+            # A rate limited replay could block this (MQTT) thread for
+            # longer than the keepalive interval.
+            threading.Thread(target=self.replay_outbox, daemon=True).start()
+        elif outbox:
+            self.replay_outbox()
+        if self.options.read_status_on_connect:
+            self.bot.read_status()
         self.bot._handler.on_connect(self.bot, mqtt)
 
+    def handle_disconnect(self, mqtt, userdata, rc):
+        self.connected = False
+        if rc != 0 and self.limiter is not None:
+            self.limiter.backoff()
+
+    def replay_outbox(self):
+        """
+        Publish stored commands, oldest first, including any sent while
+        the replay runs. Expired commands are dropped and their futures
+        fail with a `TimeoutError`.
+        """
+        outbox = self.options.outbox
+        self.expire_outbox()
+        while True:
+            unsent = outbox.unsent(self.outgoing_chan)
+            if not unsent:
+                with self._outbox_lock:
+                    unsent = outbox.unsent(self.outgoing_chan)
+                    if not unsent:
+                        self.replaying = False
+                        return
+            for (label, payload) in unsent:
+                if outbox.claim(label) and \
+                        not self.publish_outbox(label, payload):
+                    # Disconnected; the replay continues on reconnect.
+                    return
+
+    def expire_outbox(self):
+        """
+        Drop stored commands past their TTL and fail their futures with
+        a `TimeoutError`.
+        """
+        self._next_expiry = time.monotonic() + _outbox_expiry_interval
+        for label in self.options.outbox.expire(self.outgoing_chan):
+            future = self.pop_pending(label)
+            if future:
+                _settle(future, error=TimeoutError("Command expired"))
+
+    def publish_outbox(self, label, payload):
+        return self.throttle(self._publish_stored, label, payload)
+
+    def _publish_stored(self, label, payload):
+        info = self.publish_rpc(payload)
+        if info.rc != 0:
+            # Not sent (MQTT_ERR_NO_CONN, etc.); retry on reconnect.
+            self.options.outbox.unclaim(label)
+            return False
+        return True
+
     def handle_message(self, mqtt, userdata, msg):
         if msg.topic == self.status_chan:
             self.handle_status(msg)
@@ -67,30 +828,255 @@ class FarmbotConnection():
         if msg.topic == self.incoming_chan:
             self.unpack_response(msg.payload)
 
+        if msg.topic.startswith(self.sync_prefix):
+            self.handle_sync(msg)
+
+    def decode(self, payload, marker=None):
+        """
+        Parse a payload that should hold a JSON object. Anything else
+        (wrong type, too large, not an object, missing `marker`, invalid
+        JSON) is counted in `rejected` and None is returned, so that bad
+        messages never raise inside the MQTT thread. The cheap checks
+        run before the JSON parser.
+        """
+        if isinstance(payload, str):
+            start = "{"
+        elif isinstance(payload, (bytes, bytearray)):
+            start = b"{"
+            if marker is not None:
+                marker = marker.encode()
+        else:
+            self.rejected = self.rejected + 1
+            return None
+        if len(payload) > _max_payload or \
+                payload[:1] != start and payload.lstrip()[:1] != start or \
+                marker is not None and marker not in payload:
+            self.rejected = self.rejected + 1
+            return None
+        try:
+            data = json.loads(payload)
+        except (ValueError, RecursionError):
+            data = None
+        if not isinstance(data, dict):
+            self.rejected = self.rejected + 1
+            return None
+        return data
+
+    def handle_sync(self, msg):
+        # Topic: bot/device_000/sync/<Kind>/<id>
+        # {'args': {'label': '...'}, 'body': {...resource or null...}}
+        parts = msg.topic[len(self.sync_prefix):].split("/")
+        if len(parts) != 2 or not self.sync_listeners:
+            return
+        data = self.decode(msg.payload)
+        if data is None:
+            return
+        for listener in self.sync_listeners:
+            listener(parts[0], parts[1], data.get("body"))
+
+    def watch_sync(self, listener):
+        """
+        Call `listener(kind, id, body)` for every message on the `sync`
+        channel (API resource changes), subscribing to it if needed.
+        """
+        with self._lock:
+            self.sync_listeners = self.sync_listeners + [listener]
+            subscribe = self.sync_chan not in self.channels
+            if subscribe:
+                self.channels = self.channels + (self.sync_chan,)
+        if subscribe and self.connected:
+            self.mqtt.subscribe(self.sync_chan,
+                                self.channel_qos[self.sync_chan])
+
+    def unwatch_sync(self, listener):
+        with self._lock:
+            self.sync_listeners = [f for f in self.sync_listeners
+                                   if f != listener]
+
     def unpack_response(self, payload):
-        resp = json.loads(payload)
-        kind = resp["kind"]
-        label = resp["args"]["label"]
+        resp = self.decode(payload, "rpc_")
+        if resp is None:
+            return
+        kind = resp.get("kind")
+        args = resp.get("args")
+        label = args.get("label") if isinstance(args, dict) else None
+        if not isinstance(label, str):
+            self.rejected = self.rejected + 1
+            return
         if kind == "rpc_ok":
             self.handle_resp(label)
         if kind == "rpc_error":
-            self.handle_error(label, resp["body"] or [])
+            body = resp.get("body")
+            self.handle_error(label, body if isinstance(body, list) else [])
 
     def handle_resp(self, label):
         # {
         #   'kind': 'rpc_ok',
         #   'args': { 'label': 'fd0ee7c9-6ca8-11eb-9d9d-eba70539ce61' },
         # }
-        self.bot._handler.on_response(self.bot, OkResponse(label))
+        response = OkResponse(label)
+        if self.options.outbox:
+            self.options.outbox.mark_done(label)
+        if self.aggregator is not None:
+            self.sent_kinds.pop(label, None)
+        future = self.pop_pending(label)
+        if future:
+            _settle(future, response)
+        self.bot._handler.on_response(self.bot, response)
         return
 
     def handle_status(self, msg):
-        self.bot.state = json.loads(msg.payload)
-        self.bot._handler.on_change(self.bot, self.bot.state)
+        # Every status message produces a new tree, which is never
+        # modified after it is published to readers.
+        state = self.decode(msg.payload)
+        if state is None:
+            return
+        self.bot.state = state
+        if self.state_table is not None:
+            self.state_table.update(self.bot.device_id, state)
+        if self.pin_waiters:
+            self.resolve_pins(state)
+        if self.moves:
+            self.update_moves(state)
+        if state.get("jobs") or self._raw_jobs:
+            self.update_jobs(state)
+        self.bot._handler.on_change(self.bot, state)
         return
 
+    def add_pending(self, label, future):
+        key = self.label_key(label)
+        with self._lock:
+            self.pending[key] = future
+
+    def pop_pending(self, label):
+        if not self.pending:
+            return None
+        key = self.label_key(label)
+        with self._lock:
+            return self.pending.pop(key, None)
+
+    def watch_pin(self, pin_number, result, rpc):
+        """
+        Resolve `result` with the value of `pin_number` from the first
+        status update that arrives after `rpc` (the `read_pin` request)
+        succeeds. If the request fails, `result` fails with it.
+        """
+        key = str(pin_number)
+
+        def arm(done):
+            error = done.exception()
+            if error:
+                _settle(result, error=error)
+                return
+            with self._lock:
+                waiters = dict(self.pin_waiters)
+                waiters[key] = waiters.get(key, ()) + (result,)
+                self.pin_waiters = waiters
+        rpc.add_done_callback(arm)
+
+    def unwatch_pin(self, pin_number, result):
+        key = str(pin_number)
+        with self._lock:
+            waiters = dict(self.pin_waiters)
+            remaining = tuple([f for f in waiters.get(key, ())
+                               if f is not result])
+            if remaining:
+                waiters[key] = remaining
+            else:
+                waiters.pop(key, None)
+            self.pin_waiters = waiters
+
+    def watch_move(self, move):
+        with self._lock:
+            self.moves = self.moves + [move]
+        move.add_done_callback(self.unwatch_move)
+        if not move.done():
+            move.update(self.bot.state)
+        self.check_move(move)
+
+    def check_move(self, move):
+        """
+        Check `move` for stalls and timeouts, then again at its next
+        deadline, so it fails even if the device stops sending status.
+        """
+        move.check()
+        deadline = move.deadline()
+        if move.done() or deadline is None:
+            return
+        timer = threading.Timer(max(0.0, deadline - time.monotonic()),
+                                self.check_move, [move])
+        timer.daemon = True
+        move._watchdog = timer
+        timer.start()
+
+    def unwatch_move(self, move):
+        with self._lock:
+            self.moves = [m for m in self.moves if m is not move]
+        if move._watchdog is not None:
+            move._watchdog.cancel()
+
+    def update_moves(self, state):
+        now = time.monotonic()
+        for move in self.moves:
+            move.update(state, now)
+
+    def watch_jobs(self, listener):
+        with self._lock:
+            self.job_listeners = self.job_listeners + [listener]
+
+    def unwatch_jobs(self, listener):
+        with self._lock:
+            self.job_listeners = [f for f in self.job_listeners
+                                  if f != listener]
+
+    def update_jobs(self, state, now=None):
+        """
+        Update `jobs` from the jobs that changed since the last status
+        message and notify `job_listeners`.
+        """
+        raw_jobs = state.get("jobs")
+        if not isinstance(raw_jobs, dict):
+            raw_jobs = {}
+        previous = self._raw_jobs
+        self._raw_jobs = raw_jobs
+        if raw_jobs == previous:
+            return
+        now = time.monotonic() if now is None else now
+        changed = []
+        for (name, job) in raw_jobs.items():
+            if not isinstance(job, dict) or job == previous.get(name):
+                continue
+            changed.append(_job_progress(name, job, self.jobs.get(name), now))
+        if not changed:
+            return
+        jobs = dict(self.jobs)
+        jobs.update([(progress.name, progress) for progress in changed])
+        self.jobs = jobs
+        for listener in self.job_listeners:
+            for progress in changed:
+                listener(progress)
+
+    def resolve_pins(self, state):
+        pins = state.get("pins")
+        if not isinstance(pins, dict):
+            return
+        ready = [key for key in self.pin_waiters if key in pins]
+        if not ready:
+            return
+        with self._lock:
+            waiters = dict(self.pin_waiters)
+            resolved = [(key, waiters.pop(key, ())) for key in ready]
+            self.pin_waiters = waiters
+        for (key, futures) in resolved:
+            pin = pins[key]
+            value = pin.get("value") if isinstance(pin, dict) else None
+            for future in futures:
+                _settle(future, value)
+
     def handle_log(self, msg):
-        log = json.loads(msg.payload)
+        log = self.decode(msg.payload)
+        if log is None:
+            return
         self.bot._handler.on_log(self.bot, log)
         return
 
@@ -104,119 +1090,1267 @@ class FarmbotConnection():
         #     ],
         # }
 
-        tidy_errors = []
-        for error in errors:
-            args = error["args"] or {"message": "No message provided"}
-            message = args["message"]
-            tidy_errors.append(message)
-        self.bot._handler.on_error(self.bot, ErrorResponse(label, tidy_errors))
-        return
+        tidy_errors = []
+        kinds = []
+        for error in errors:
+            if not isinstance(error, dict):
+                error = {}
+            args = error.get("args")
+            message = args.get("message") if isinstance(args, dict) else None
+            if not isinstance(message, str) or not message:
+                message = _no_message
+            kind = error.get("kind")
+            if not isinstance(kind, str) or not kind:
+                kind = "explanation"
+            # The same few messages repeat across errors and devices.
+            tidy_errors.append(sys.intern(message))
+            kinds.append(sys.intern(kind))
+        response = ErrorResponse(label, tidy_errors, kinds)
+        if self.options.outbox:
+            self.options.outbox.mark_done(label)
+        future = self.pop_pending(label)
+        if future:
+            _settle(future, error=response.exception())
+        if self.aggregator is not None:
+            self.aggregator.record(self.bot.device_id,
+                                   self.sent_kinds.pop(label, "unknown"),
+                                   tidy_errors)
+        self.bot._handler.on_error(self.bot, response)
+        return
+
+    def track_errors(self, aggregator):
+        """
+        Count this device's errors in an `ErrorAggregator`.
+        """
+        # Label => command kind, so errors can be counted per command.
+        # Bounded, since most commands never fail.
+        self.sent_kinds = _BoundedDict(10000)
+        self.aggregator = aggregator
+
+    def send_emergency_lock(self, future=None):
+        """
+        Publish an `emergency_lock` immediately at QoS 1 (or higher, if
+        configured), from a pre-serialized payload. This bypasses the
+        outbox and everything else `send_rpc()` does, so an e-stop never
+        waits behind other traffic. When the device answers, the latency
+        is appended to `lock_latencies` and `future`, if given, is
+        resolved with it.
+        """
+        label = self.new_label()
+        payload = _estop_head + json.dumps(label) + _estop_tail
+        rpc = Future()
+        rpc.sent_at = time.monotonic()
+
+        def done(rpc):
+            error = rpc.exception()
+            if error:
+                if future is not None:
+                    _settle(future, error=error)
+                return
+            latency = time.monotonic() - rpc.sent_at
+            self.lock_latencies.append(latency)
+            if future is not None:
+                _settle(future, latency)
+        rpc.add_done_callback(done)
+        if future is not None:
+            future.label = label
+        self.add_pending(label, rpc)
+        qos = max(1, self.channel_qos[self.outgoing_chan])
+        try:
+            info = self.mqtt.publish(self.outgoing_chan, payload, qos=qos)
+            if info.rc != 0:
+                # Never queued by paho (MQTT_ERR_NO_CONN, etc.).
+                raise ConnectionError("emergency_lock not sent (rc=%d)"
+                                      % info.rc)
+        except Exception as error:
+            self.pop_pending(label)
+            _settle(rpc, error=error)
+            raise
+        return label
+
+    def send_rpc(self, rpc, future=None):
+        """
+        Publish one `rpc_request` and return its label. If a `future` is
+        given, it is resolved with the `OkResponse` (or fails with an
+        `RpcError`) when the device answers.
+        """
+        label = self.new_label()
+        message = {"kind": "rpc_request", "args": {"label": label}}
+        if isinstance(rpc, list):
+            message["body"] = rpc
+        else:
+            message["body"] = [rpc]
+        payload = json.dumps(message)
+        if future is not None:
+            future.label = label
+            self.add_pending(label, future)
+        if self.aggregator is not None:
+            body = message["body"]
+            kind = body[0].get("kind") if len(body) == 1 else "batch"
+            self.sent_kinds.set(label, kind)
+        outbox = self.options.outbox
+        if outbox:
+            if time.monotonic() >= self._next_expiry:
+                self.expire_outbox()
+            with self._outbox_lock:
+                outbox.add(label, self.outgoing_chan, payload)
+                publish = self.connected and not self.replaying
+            if publish and outbox.claim(label):
+                self.publish_outbox(label, payload)
+            return label
+        self.throttle(self.publish_rpc, payload)
+        return label
+
+    def throttle(self, publish, *args):
+        """
+        Call `publish(*args)` once the rate limiter (if any) allows it
+        and return its result. Other threads wait, but the MQTT thread
+        (handlers, `on_connect`) must keep the connection alive, so
+        there the publish is handed to the limiter's scheduler and None
+        is returned.
+        """
+        if self.limiter is None:
+            return publish(*args)
+        if threading.current_thread() is self.network_thread:
+            wait = self.limiter.reserve()
+            if wait > 0:
+                self.limiter.scheduler.call_later(wait, publish, *args)
+                return None
+            return publish(*args)
+        self.limiter.acquire()
+        return publish(*args)
+
+    def publish_rpc(self, payload):
+        qos = self.channel_qos[self.outgoing_chan]
+        sent_at = time.monotonic()
+        info = self.mqtt.publish(self.outgoing_chan, payload, qos=qos)
+        if self.limiter is not None and qos > 0:
+            acked_at = self.acked_at.pop(info.mid, None)
+            if acked_at is not None and acked_at >= sent_at:
+                self.limiter.observe_latency(acked_at - sent_at)
+            else:
+                self.sent_at.set(info.mid, sent_at)
+        return info
+
+    def handle_publish(self, mqtt, userdata, mid):
+        if self.limiter is None or \
+                not self.channel_qos[self.outgoing_chan]:
+            return
+        now = time.monotonic()
+        sent_at = self.sent_at.pop(mid, None)
+        if sent_at is None:
+            self.acked_at.set(mid, now)
+        else:
+            self.limiter.observe_latency(now - sent_at)
+
+
+# Seconds between TTL checks of the outbox while connected.
+_outbox_expiry_interval = 60.0
+
+# `emergency_lock` request, split around its label.
+_estop_head = '{"kind": "rpc_request", "args": {"label": '
+_estop_tail = ('}, "body": [{"kind": "emergency_lock", '
+               '"args": {}, "body": []}]}')
+
+
+class _BoundedDict():
+    """
+    A thread-safe dict that forgets its oldest entries past `size`.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            if len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+
+class _CountMinTopK():
+    """
+    Approximate counts for an unbounded set of keys in fixed memory: a
+    count-min sketch (`depth` rows of `width` counters) plus the `k`
+    keys with the highest estimated counts. Estimates may overcount,
+    never undercount.
+
+    Each row is indexed by its own 4 bytes of one BLAKE2b digest of the
+    key, so the rows are independent (keys that collide in one row are
+    unlikely to collide in the others) and the same in every process.
+    """
+
+    def __init__(self, width, depth, k):
+        if depth > 16:
+            raise ValueError("depth must be 16 or less")
+        self.width = width
+        self.depth = depth
+        self.k = k
+        self.rows = [[0] * width for _ in range(depth)]
+        self.top = {}
+
+    def _indexes(self, key):
+        import hashlib
+        digest = hashlib.blake2b(repr(key).encode(),
+                                 digest_size=4 * self.depth).digest()
+        return [int.from_bytes(digest[i:i + 4], "little") % self.width
+                for i in range(0, len(digest), 4)]
+
+    def add(self, key, count=1):
+        estimate = None
+        for (index, row) in zip(self._indexes(key), self.rows):
+            row[index] = row[index] + count
+            if estimate is None or row[index] < estimate:
+                estimate = row[index]
+        if key in self.top or len(self.top) < self.k:
+            self.top[key] = estimate
+            return
+        smallest = min(self.top, key=self.top.get)
+        if estimate > self.top[smallest]:
+            del self.top[smallest]
+            self.top[key] = estimate
+
+    def estimate(self, key):
+        return min([row[index]
+                    for (index, row) in zip(self._indexes(key), self.rows)])
+
+
+class ErrorAggregator():
+    """
+    Counts `rpc_error`s per device, per command kind and per message in
+    fixed memory, to spot misbehaving bots without storing every error.
+    Share one aggregator between bots with `bot.track_errors()`.
+
+        errors = ErrorAggregator()
+        for bot in bots:
+            bot.track_errors(errors)
+        ...
+        print(errors.top("device", 5))
+    """
+    dimensions = ("device", "kind", "message")
+
+    def __init__(self, width=1024, depth=4, k=20):
+        self.total = 0
+        self._lock = threading.Lock()
+        self._sketches = dict([(name, _CountMinTopK(width, depth, k))
+                               for name in self.dimensions])
+
+    def record(self, device_id, kind, messages):
+        with self._lock:
+            self.total = self.total + 1
+            self._sketches["device"].add(device_id)
+            self._sketches["kind"].add(kind)
+            for message in messages:
+                self._sketches["message"].add(message)
+
+    def estimate(self, dimension, key):
+        """
+        Approximate number of errors for one device, command kind or
+        message, depending on `dimension`.
+        """
+        with self._lock:
+            return self._sketches[dimension].estimate(key)
+
+    def top(self, dimension, n=None):
+        """
+        The (key, count) pairs with the most errors, highest first.
+        """
+        with self._lock:
+            top = list(self._sketches[dimension].top.items())
+        top.sort(key=lambda item: item[1], reverse=True)
+        return top[:n]
+
+
+class StubHandler:
+    def on_connect(self, bot, client): pass
+    def on_change(self, bot, state): pass
+    def on_log(self, _bot, log): pass
+    def on_error(self, _bot, _response): pass
+    def on_response(self, _bot, _response): pass
+
+
+def urlopen(*args, **kwargs):
+    from urllib.request import urlopen
+    return urlopen(*args, **kwargs)
+
+
+class FarmbotToken():
+    @staticmethod
+    def download_token(email,
+                       password,
+                       server="https://my.farm.bot"):
+        """
+        Returns a byte stream representation of the
+        """
+        from urllib.request import Request
+        req = Request(server + "/api/tokens")
+        req.add_header("Content-Type", "application/json")
+        data = {"user": {"email": email, "password": password}}
+        string = json.dumps(data)
+        as_bytes = str.encode(string)
+        response = urlopen(req, as_bytes)
+
+        return response.read()
+
+    def __init__(self, raw_token):
+        token_data = json.loads(raw_token)
+        self.raw_token = raw_token
+        token = token_data["token"]["unencoded"]
+        self.jwt = token_data["token"]["encoded"]
+
+        self.bot = token["bot"]
+        self.exp = token["exp"]
+        self.iat = token["iat"]
+        self.iss = token["iss"]
+        self.jti = token["jti"]
+        self.mqtt = token["mqtt"]
+        self.mqtt_ws = token["mqtt_ws"]
+        self.sub = token["sub"]
+        self.vhost = token["vhost"]
+
+
+empty_xyz = {"x": None, "y": None, "z": None}
+zero_xyz = {"x": 0, "y": 0, "z": 0}
+
+
+def empty_state():
+    """
+    This is what the bot's state tree looks like.
+    This helper method creates an empty object that is mostly
+    unpopulated.
+    """
+    return {
+        "configuration": {},
+        "informational_settings": {},
+        "jobs": {},
+        "location_data": {
+            "axis_states": empty_xyz,
+            "load": empty_xyz,
+            "position": empty_xyz,
+            "raw_encoders": empty_xyz,
+            "scaled_encoders": empty_xyz,
+        },
+        "mcu_params": {},
+        "pins": {},
+        "user_env": {}
+    }
+
+
+_pin_modes = {"digital": 0, "analog": 1}
+_pin_mode_names = {0: "digital", 1: "analog"}
+
+
+def _pin_mode(pin_mode):
+    if pin_mode not in _pin_modes:
+        raise ValueError("Unknown pin mode: " + str(pin_mode))
+    return _pin_modes[pin_mode]
+
+
+# Arguments of the commands that both `Farmbot` and `Sequence` send.
+def _move_absolute_args(x, y, z, speed):
+    return {
+        "location": {"kind": "coordinate", "args": {"x": x, "y": y, "z": z, }},
+        "speed": speed,
+        "offset": {"kind": "coordinate", "args": zero_xyz}
+    }
+
+
+def _move_relative_args(x, y, z, speed):
+    return {"x": x, "y": y, "z": z, "speed": speed}
+
+
+def _write_pin_args(pin_number, pin_value, pin_mode):
+    return {
+        "pin_mode": _pin_mode(pin_mode),
+        "pin_number": pin_number,
+        "pin_value": pin_value
+    }
+
+
+def _read_pin_args(pin_number, pin_mode):
+    return {
+        "label": "pin" + str(pin_number),
+        "pin_mode": _pin_mode(pin_mode),
+        "pin_number": pin_number
+    }
+
+
+def _lua_value(value):
+    """
+    Render a Python value as a Lua literal.
+    """
+    import math
+    if value is None:
+        return "nil"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, float) and not math.isfinite(value):
+        raise ValueError("Lua has no literal for " + repr(value))
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return '"' + "".join([_lua_escape(c) for c in str(value)]) + '"'
+
+
+def _lua_escape(char):
+    if char in '"\\':
+        return "\\" + char
+    if ord(char) < 32 or ord(char) == 127:
+        # JSON's \u00XX is not valid Lua. Always use three digits, so
+        # a digit that follows is not read as part of the escape.
+        return "\\%03d" % ord(char)
+    return char
+
+
+class Sequence():
+    """
+    Records a routine of device commands so that it can be sent to
+    the device as a single message (one `lua` call or one multi-node
+    `rpc_request`) rather than one MQTT round trip per step.
+
+        seq = Sequence("water row")
+        seq.move_absolute(0, 0, 0)
+        with seq.repeat(3) as loop:
+            loop.write_pin(7, 1)
+            loop.wait(500)
+        with seq.if_pin(13, "==", 1) as then:
+            then.send_message("Soil is wet")
+        bot.run_sequence(seq)
+    """
+    lua_ops = {"==": "==", "!=": "~=", "<": "<", ">": ">",
+               "<=": "<=", ">=": ">="}
+
+    def __init__(self, name="sequence"):
+        self.name = name
+        self.steps = []
+
+    def __len__(self):
+        return len(self.steps)
+
+    def _do_cs(self, kind, args, body=[]):
+        self.steps.append({"kind": kind, "args": args, "body": body})
+        return self
+
+    def move_absolute(self, x, y, z, speed=100.0):
+        return self._do_cs("move_absolute",
+                           _move_absolute_args(x, y, z, speed))
+
+    def move_relative(self, x, y, z, speed=100):
+        return self._do_cs("move_relative",
+                           _move_relative_args(x, y, z, speed))
+
+    def write_pin(self, pin_number, pin_value, pin_mode="digital"):
+        return self._do_cs("write_pin",
+                           _write_pin_args(pin_number, pin_value, pin_mode))
+
+    def read_pin(self, pin_number, pin_mode="digital"):
+        return self._do_cs("read_pin", _read_pin_args(pin_number, pin_mode))
+
+    def send_message(self, msg, type="info"):
+        return self._do_cs("send_message",
+                           {"message": msg, "message_type": type, })
+
+    def wait(self, milliseconds):
+        return self._do_cs("wait", {"milliseconds": milliseconds})
+
+    @contextmanager
+    def repeat(self, times):
+        """
+        Repeat the steps recorded inside the `with` block `times` times.
+        """
+        if not isinstance(times, int) or isinstance(times, bool) or \
+                times < 0:
+            raise ValueError("times must be a non-negative integer: "
+                             + repr(times))
+        loop = Sequence(self.name)
+        yield loop
+        self.steps.append({"kind": "_repeat",
+                           "args": {"times": times},
+                           "body": loop.steps})
+
+    @contextmanager
+    def if_pin(self, pin_number, op, value, pin_mode="digital"):
+        """
+        Run the steps recorded inside the `with` block only if the pin
+        comparison holds on the device. Conditionals are evaluated on the
+        device, so they can only be compiled to Lua.
+        """
+        if op not in self.lua_ops:
+            raise ValueError("Unsupported comparison: " + str(op))
+        _pin_mode(pin_mode)
+        then = Sequence(self.name)
+        yield then
+        self.steps.append({"kind": "_if_pin",
+                           "args": {"pin_number": pin_number,
+                                    "pin_mode": pin_mode,
+                                    "op": op,
+                                    "value": value},
+                           "body": then.steps})
+
+    def to_celery_script(self):
+        """
+        Compile the routine into a flat list of CeleryScript nodes,
+        suitable for the body of a single `rpc_request`. Loops are
+        unrolled. Raises ValueError if the routine contains a conditional.
+        """
+        return self._flatten(self.steps)
+
+    def _flatten(self, steps):
+        nodes = []
+        for step in steps:
+            if step["kind"] == "_repeat":
+                body = self._flatten(step["body"])
+                for _ in range(step["args"]["times"]):
+                    nodes.extend(body)
+            elif step["kind"] == "_if_pin":
+                raise ValueError("Conditionals require the Lua compiler")
+            else:
+                nodes.append(step)
+        return nodes
+
+    def to_lua(self, progress=True):
+        """
+        Compile the routine into a Lua program. When `progress` is set,
+        the device sends a "debug" log after each top level step so that
+        progress can be followed through `on_log`.
+        """
+        lines = []
+        total = len(self.steps)
+        for (index, step) in enumerate(self.steps):
+            self._lua_step(step, lines, "")
+            if progress:
+                message = "%s: step %d/%d" % (self.name, index + 1, total)
+                lines.append("send_message(\"debug\", %s)"
+                             % _lua_value(message))
+        return "\n".join(lines)
+
+    def _lua_step(self, step, lines, indent):
+        kind = step["kind"]
+        args = step["args"]
+        if kind == "_repeat":
+            lines.append(indent + "for _ = 1, %d do" % args["times"])
+            for child in step["body"]:
+                self._lua_step(child, lines, indent + "  ")
+            lines.append(indent + "end")
+            return
+        if kind == "_if_pin":
+            lines.append(indent + "if read_pin(%s, %s) %s %s then" % (
+                _lua_value(args["pin_number"]),
+                _lua_value(args["pin_mode"]),
+                self.lua_ops[args["op"]],
+                _lua_value(args["value"])))
+            for child in step["body"]:
+                self._lua_step(child, lines, indent + "  ")
+            lines.append(indent + "end")
+            return
+        if kind == "move_absolute":
+            xyz = args["location"]["args"]
+            call = ("move_absolute", xyz["x"], xyz["y"], xyz["z"],
+                    args["speed"])
+        elif kind == "move_relative":
+            call = ("move_relative", args["x"], args["y"], args["z"],
+                    args["speed"])
+        elif kind == "write_pin":
+            call = ("write_pin", args["pin_number"],
+                    _pin_mode_names[args["pin_mode"]], args["pin_value"])
+        elif kind == "read_pin":
+            call = ("read_pin", args["pin_number"],
+                    _pin_mode_names[args["pin_mode"]])
+        elif kind == "send_message":
+            call = ("send_message", args["message_type"], args["message"])
+        elif kind == "wait":
+            call = ("wait", args["milliseconds"])
+        else:
+            raise ValueError("Cannot compile to Lua: " + kind)
+        params = ", ".join([_lua_value(v) for v in call[1:]])
+        lines.append(indent + call[0] + "(" + params + ")")
+
+
+class PinPollStats():
+    """
+    Results of `Farmbot.poll_pins()`: the requested tick rate versus the
+    rate that was actually achieved.
+    """
+
+    def __init__(self, requested_hz):
+        self.requested_hz = requested_hz
+        self.ticks = 0
+        self.late_ticks = 0
+        self.samples = 0
+        self.errors = 0
+        self.elapsed = 0.0
+
+    @property
+    def achieved_hz(self):
+        if not self.elapsed:
+            return 0.0
+        return self.ticks / self.elapsed
+
+    def _sampler(self, pin_number, callback):
+        def sample(future):
+            if future.exception():
+                self.errors = self.errors + 1
+                return
+            self.samples = self.samples + 1
+            if callback:
+                callback(pin_number, future.result())
+        return sample
+
+
+class StallError(Exception):
+    """
+    Raised by a `MoveFuture` when the motors stop making progress
+    before the target is reached.
+    """
+
+
+class MoveFuture(Future):
+    """
+    A `Future` that tracks a movement towards `target`. It resolves
+    with the reason the move is considered complete, whichever comes
+    first:
+
+      * "rpc_ok" - the device acknowledged the movement command.
+      * "position" - the reported position is within `tolerance` (mm,
+        per axis) of the target.
+
+    It fails with an `RpcError` if the device rejects the command, a
+    `StallError` if neither the position nor `raw_encoders` change for
+    `stall_timeout`
+    seconds (or an axis `load` exceeds `max_load`) and a `TimeoutError`
+    if the move takes longer than `timeout` seconds. Stalls and
+    timeouts are detected even if no status updates arrive.
+    """
+
+    def __init__(self, target, tolerance=1.0, timeout=None,
+                 stall_timeout=None, max_load=None):
+        super().__init__()
+        self.label = None
+        self.target = target
+        self.tolerance = tolerance
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.max_load = max_load
+        self.started_at = time.monotonic()
+        self.remaining = None
+        self.velocity = None
+        self._last_position = None
+        self._last_sample_at = None
+        self._last_encoders = None
+        # Last time the position or encoders changed.
+        self._progress_at = self.started_at
+        # Timer for the next `check()`, set by the connection.
+        self._watchdog = None
+
+    def track_rpc(self, rpc):
+        """
+        Resolve (or fail) this move when the `rpc` Future settles.
+        """
+        def done(rpc):
+            error = rpc.exception()
+            if error:
+                _settle(self, error=error)
+            else:
+                _settle(self, "rpc_ok")
+        rpc.add_done_callback(done)
+
+    def eta(self):
+        """
+        Estimated seconds until the target is reached, based on the
+        velocity observed so far, or None if no movement was seen yet.
+        """
+        if self.done():
+            return 0.0
+        if self.remaining is None or not self.velocity:
+            return None
+        return self.remaining / self.velocity
+
+    def update(self, state, now=None):
+        if self.done():
+            return
+        now = time.monotonic() if now is None else now
+        location = state.get("location_data")
+        if not isinstance(location, dict):
+            location = {}
+        position = _xyz(location.get("position"))
+        if position:
+            if position != self._last_position:
+                self._progress_at = now
+            self._sample(position, now)
+            if self.remaining <= self.tolerance:
+                _settle(self, "position")
+                return
+        # Bots without (or with disabled) encoders still report their
+        # position, so either counts as progress.
+        encoders = _xyz(location.get("raw_encoders"))
+        if encoders != self._last_encoders:
+            self._last_encoders = encoders
+            self._progress_at = now
+        load = _xyz(location.get("load"))
+        if self.max_load is not None and load and \
+                max([abs(v) for v in load]) >= self.max_load:
+            _settle(self, error=StallError("Motor load exceeded"))
+            return
+        self.check(now)
+
+    def check(self, now=None):
+        """
+        Fail the move if it stalled or timed out by `now`.
+        """
+        if self.done():
+            return
+        now = time.monotonic() if now is None else now
+        if self.stall_timeout is not None and \
+                now - self._progress_at >= self.stall_timeout:
+            _settle(self, error=StallError("Motors stopped moving"))
+            return
+        if self.timeout is not None and \
+                now - self.started_at >= self.timeout:
+            _settle(self, error=TimeoutError("Move did not complete"))
+
+    def deadline(self):
+        """
+        The `time.monotonic()` time of the next stall or timeout check,
+        or None if neither is enabled.
+        """
+        deadlines = []
+        if self.stall_timeout is not None:
+            deadlines.append(self._progress_at + self.stall_timeout)
+        if self.timeout is not None:
+            deadlines.append(self.started_at + self.timeout)
+        return min(deadlines) if deadlines else None
+
+    def _sample(self, position, now):
+        self.remaining = max([abs(a - b)
+                              for (a, b) in zip(position, self.target)])
+        if self._last_position is not None and now > self._last_sample_at:
+            moved = max([abs(a - b)
+                         for (a, b) in zip(position, self._last_position)])
+            speed = moved / (now - self._last_sample_at)
+            if speed > 0:
+                # Smooth out jitter between status updates.
+                if self.velocity:
+                    speed = (0.5 * self.velocity) + (0.5 * speed)
+                self.velocity = speed
+        self._last_position = position
+        self._last_sample_at = now
+
+
+JobProgress = namedtuple("JobProgress", ["name", "status", "percent",
+                                         "rate", "type", "updated_at"])
+JobProgress.__doc__ = """
+The latest known state of a job (such as a FarmBot OS update) from the
+`jobs` part of the state tree. `rate` is in percent per second, or
+None until the percentage has changed twice. `updated_at` is a
+`time.monotonic()` timestamp.
+"""
+
+_job_done = ("complete", "completed", "done")
+_job_failed = ("error", "failed", "failure")
+
+
+def _job_progress(name, job, last, now):
+    status = job.get("status")
+    if not isinstance(status, str):
+        status = None
+    percent = job.get("percent")
+    if not isinstance(percent, (int, float)) or isinstance(percent, bool):
+        percent = None
+    kind = job.get("type")
+    if not isinstance(kind, str):
+        kind = None
+    rate = None
+    if last is not None:
+        rate = last.rate
+        if percent is not None and last.percent is not None and \
+                percent > last.percent and now > last.updated_at:
+            rate = (percent - last.percent) / (now - last.updated_at)
+            # Smooth out jitter between status updates.
+            if last.rate:
+                rate = (0.5 * last.rate) + (0.5 * rate)
+    return JobProgress(name, status, percent, rate, kind, now)
+
+
+class JobError(Exception):
+    """
+    Raised by a `JobFuture` when the device reports that its job failed.
+    """
+
+
+class JobFuture(Future):
+    """
+    A `Future` for the job called `name` (such as "FBOS_OTA" for a
+    FarmBot OS update) that a command starts. It follows changes to
+    that job after the command was sent and resolves with its final
+    `JobProgress` once its status is complete or it reaches 100%. If the
+    device acknowledges the command before the job changes (there was
+    nothing to do), it resolves with None.
+
+    It fails with an `RpcError` if the device rejects the command, and a
+    `JobError` if the job's status becomes an error. `progress` is the
+    latest `JobProgress` seen, and `on_progress(progress)`, if given, is
+    called with each one.
+    """
+
+    def __init__(self, name, on_progress=None):
+        super().__init__()
+        self.label = None
+        self.name = name
+        self.on_progress = on_progress
+        self.progress = None
+
+    def track_rpc(self, rpc):
+        """
+        Fail this job if the `rpc` Future fails, or resolve it if the
+        `rpc` succeeds before the job was seen.
+        """
+        def done(rpc):
+            error = rpc.exception()
+            if error:
+                _settle(self, error=error)
+            elif self.progress is None:
+                _settle(self, None)
+        rpc.add_done_callback(done)
+
+    def update(self, progress):
+        if self.done() or progress.name != self.name:
+            return
+        self.progress = progress
+        if self.on_progress:
+            self.on_progress(progress)
+        status = (progress.status or "").lower()
+        if status in _job_failed:
+            _settle(self, error=JobError(progress.name + ": " +
+                                         progress.status))
+        elif status in _job_done or (progress.percent or 0) >= 100:
+            _settle(self, progress)
+
+    def eta(self):
+        """
+        Estimated seconds until the job completes, based on its rate so
+        far, or None if it is unknown.
+        """
+        if self.done():
+            return 0.0
+        progress = self.progress
+        if progress is None or progress.percent is None or not progress.rate:
+            return None
+        return (100 - progress.percent) / progress.rate
+
+
+def _xyz(axes):
+    """
+    Convert an {x, y, z} dict from the state tree into a tuple, or None
+    if any axis is unknown.
+    """
+    if not isinstance(axes, dict):
+        return None
+    xyz = (axes.get("x"), axes.get("y"), axes.get("z"))
+    for value in xyz:
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            return None
+    return xyz
+
+
+StateSnapshot = namedtuple("StateSnapshot", ["version", "state"])
+StateSnapshot.__doc__ = """
+A point-in-time view of the bot's state tree. `version` increases by
+one with every status update.
+"""
+
+
+_table_magic = b"FBST"
+# Magic, capacity, rows in use, pin count; then up to 64 pin numbers.
+_table_header = "<4sIII64i"
+_table_count_offset = 8
+# Names of the tables created by this process.
+_created_tables = set()
+_table_max_pins = 64
+_table_columns = ("x", "y", "z", "encoder_x", "encoder_y", "encoder_z")
+
+
+class FleetStateTable():
+    """
+    One fixed-size row per device in shared memory, with the position,
+    scaled encoder positions, busy and locked flags and the values of
+    selected pins. Bots added with `Farmbot.track_state(table)` update
+    their row in place on every status message, so other processes can
+    read the whole fleet without copying state trees:
+
+        table = FleetStateTable(capacity=500, pins=(13, 59))
+        bot.track_state(table)
+        # In another process:
+        table = FleetStateTable(name=table.name, attach=True)
+        table.idle_in_region(0, 1500, 0, 3000)
+
+    Unknown values are NaN (False for the flags). `array()` returns a
+    NumPy structured array over the same memory, when NumPy is
+    installed. While a row is being written its `seq` column is odd;
+    `row()` retries until it reads a consistent row.
+
+    Rows are allocated by the process that created the table (from
+    any of its threads). Other processes may update rows that were
+    already added; `add()` raises `ValueError` there for new devices.
+    """
+
+    def __init__(self, capacity=256, pins=(), name=None, attach=False):
+        from multiprocessing import shared_memory
+        import struct
+        self._header = struct.Struct(_table_header)
+        self._seq = struct.Struct("<I")
+        if attach:
+            self._shm = shared_memory.SharedMemory(name=name)
+            if self._shm.name not in _created_tables:
+                _untrack_shared_memory(self._shm)
+            (magic, capacity, _, pin_count) = self._header.unpack_from(
+                self._shm.buf, 0)[:4]
+            if magic != _table_magic:
+                self._shm.close()
+                raise ValueError("Not a FleetStateTable: " + repr(name))
+            pins = self._header.unpack_from(self._shm.buf, 0)[4:][:pin_count]
+        elif len(pins) > _table_max_pins:
+            raise ValueError("At most 64 pins can be tracked")
+        self.capacity = capacity
+        self.pins = tuple(pins)
+        formats = "dddddd??" + "d" * len(self.pins)
+        self._body = struct.Struct("<" + formats)
+        self._row = struct.Struct("<32sI" + formats)
+        if not attach:
+            size = self._header.size + self._row.size * capacity
+            self._shm = shared_memory.SharedMemory(name=name, create=True,
+                                                   size=size)
+            pin_slots = list(self.pins) + [0] * (64 - len(self.pins))
+            self._header.pack_into(self._shm.buf, 0, _table_magic, capacity,
+                                   0, len(self.pins), *pin_slots)
+            _created_tables.add(self._shm.name)
+        self.name = self._shm.name
+        self.attached = attach
+        # Device ID => row number.
+        self._rows = {}
+        # Serializes row allocation between this process's threads.
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._seq.unpack_from(self._shm.buf, _table_count_offset)[0]
+
+    def _offset(self, row):
+        return self._header.size + row * self._row.size
+
+    def _find(self, device_id):
+        if device_id not in self._rows:
+            key = str(device_id).encode()
+            for row in range(len(self)):
+                if self._row.unpack_from(self._shm.buf,
+                                         self._offset(row))[0] \
+                        .rstrip(b"\0") == key:
+                    self._rows[device_id] = row
+        return self._rows.get(device_id)
+
+    def add(self, device_id):
+        """
+        Give `device_id` a row (if it has none yet) and return its number.
+        Only the creating process can add new devices.
+        """
+        with self._lock:
+            row = self._find(device_id)
+            if row is not None:
+                return row
+            if self.attached:
+                raise ValueError("Rows are allocated by the process that "
+                                 "created the table: " + repr(device_id))
+            key = str(device_id).encode()
+            if len(key) > 32:
+                raise ValueError("Device IDs are limited to 32 bytes")
+            row = len(self)
+            if row >= self.capacity:
+                raise ValueError("FleetStateTable is full")
+            nan = float("nan")
+            values = [nan] * 6 + [False, False] + [nan] * len(self.pins)
+            self._row.pack_into(self._shm.buf, self._offset(row), key, 0,
+                                *values)
+            self._seq.pack_into(self._shm.buf, _table_count_offset, row + 1)
+            self._rows[device_id] = row
+            return row
+
+    def update(self, device_id, state):
+        """
+        Copy the tracked columns from a state tree into `device_id`'s row.
+        """
+        row = self._find(device_id)
+        if row is None:
+            return
+        nan = float("nan")
+        location = state.get("location_data")
+        if not isinstance(location, dict):
+            location = {}
+        info = state.get("informational_settings")
+        if not isinstance(info, dict):
+            info = {}
+        pins = state.get("pins")
+        if not isinstance(pins, dict):
+            pins = {}
+        values = list(_xyz(location.get("position")) or (nan, nan, nan))
+        values.extend(_xyz(location.get("scaled_encoders")) or
+                      (nan, nan, nan))
+        values.append(info.get("busy") is True)
+        values.append(info.get("locked") is True)
+        for pin in self.pins:
+            pin_state = pins.get(str(pin))
+            value = nan
+            if isinstance(pin_state, dict):
+                value = pin_state.get("value")
+                if not isinstance(value, (int, float)) or \
+                        isinstance(value, bool):
+                    value = nan
+            values.append(value)
+        offset = self._offset(row) + 32
+        seq = self._seq.unpack_from(self._shm.buf, offset)[0]
+        self._seq.pack_into(self._shm.buf, offset, (seq + 1) & 0xFFFFFFFF)
+        self._body.pack_into(self._shm.buf, offset + 4, *values)
+        self._seq.pack_into(self._shm.buf, offset, (seq + 2) & 0xFFFFFFFF)
+
+    def _read(self, row):
+        while True:
+            values = self._row.unpack_from(self._shm.buf, self._offset(row))
+            seq = self._seq.unpack_from(self._shm.buf,
+                                        self._offset(row) + 32)[0]
+            if values[1] % 2 == 0 and values[1] == seq:
+                break
+            time.sleep(0)
+        record = {"device_id": values[0].rstrip(b"\0").decode(),
+                  "seq": values[1]}
+        record.update(zip(_table_columns, values[2:8]))
+        record["busy"] = values[8]
+        record["locked"] = values[9]
+        record["pins"] = dict(zip(self.pins, values[10:]))
+        return record
 
-    def send_rpc(self, rpc):
-        label = str(uuid.uuid1())
-        message = {"kind": "rpc_request", "args": {"label": label}}
-        if isinstance(rpc, list):
-            message["body"] = rpc
-        else:
-            message["body"] = [rpc]
-        payload = json.dumps(message)
-        self.mqtt.publish(self.outgoing_chan, payload)
-        return label
+    def row(self, device_id):
+        """
+        `device_id`'s row as a dict, or None if it has no row.
+        """
+        row = self._find(device_id)
+        if row is None:
+            return None
+        return self._read(row)
 
+    def rows(self):
+        return [self._read(row) for row in range(len(self))]
 
-class StubHandler:
-    def on_connect(self, bot, client): pass
-    def on_change(self, bot, state): pass
-    def on_log(self, _bot, log): pass
-    def on_error(self, _bot, _response): pass
-    def on_response(self, _bot, _response): pass
+    def dtype(self):
+        import numpy
+        fields = [("device_id", "S32"), ("seq", "<u4")]
+        fields.extend([(column, "<f8") for column in _table_columns])
+        fields.extend([("busy", "?"), ("locked", "?")])
+        fields.extend([("pin_%d" % pin, "<f8") for pin in self.pins])
+        return numpy.dtype(fields)
 
+    def array(self):
+        """
+        A NumPy structured array over the rows in use (no copy).
+        Requires NumPy. Delete the array before calling `close()`.
+        """
+        import numpy
+        return numpy.ndarray(shape=(len(self),), dtype=self.dtype(),
+                             buffer=self._shm.buf,
+                             offset=self._header.size)
 
-class FarmbotToken():
-    @staticmethod
-    def download_token(email,
-                       password,
-                       server="https://my.farm.bot"):
+    def idle_in_region(self, x_min, x_max, y_min, y_max):
         """
-        Returns a byte stream representation of the
+        Device IDs of bots that are neither busy nor locked, and whose
+        position is within the given bounds (inclusive).
         """
-        req = Request(server + "/api/tokens")
-        req.add_header("Content-Type", "application/json")
-        data = {"user": {"email": email, "password": password}}
-        string = json.dumps(data)
-        as_bytes = str.encode(string)
-        response = urlopen(req, as_bytes)
+        try:
+            import numpy  # noqa: F401
+        except ImportError:
+            return [record["device_id"] for record in self.rows()
+                    if not record["busy"] and not record["locked"] and
+                    x_min <= record["x"] <= x_max and
+                    y_min <= record["y"] <= y_max]
+        table = self.array()
+        found = (~table["busy"] & ~table["locked"] &
+                 (table["x"] >= x_min) & (table["x"] <= x_max) &
+                 (table["y"] >= y_min) & (table["y"] <= y_max))
+        return [device_id.decode() for device_id in table["device_id"][found]]
 
-        return response.read()
+    def close(self):
+        self._shm.close()
 
-    def __init__(self, raw_token):
-        token_data = json.loads(raw_token)
-        self.raw_token = raw_token
-        token = token_data["token"]["unencoded"]
-        self.jwt = token_data["token"]["encoded"]
+    def unlink(self):
+        """
+        Free the shared memory. Call once, from the creating process.
+        """
+        self._shm.unlink()
+        _created_tables.discard(self._shm.name)
 
-        self.bot = token["bot"]
-        self.exp = token["exp"]
-        self.iat = token["iat"]
-        self.iss = token["iss"]
-        self.jti = token["jti"]
-        self.mqtt = token["mqtt"]
-        self.mqtt_ws = token["mqtt_ws"]
-        self.sub = token["sub"]
-        self.vhost = token["vhost"]
 
+def _untrack_shared_memory(shm):
+    # Before Python 3.13, attaching to a segment registers it with the
+    # resource tracker, which would unlink it when this process exits.
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except (ImportError, AttributeError, KeyError):
+        pass
 
-empty_xyz = {"x": None, "y": None, "z": None}
-zero_xyz = {"x": 0, "y": 0, "z": 0}
 
+# Every Farmbot in this process, for `emergency_lock_all()`.
+_bots = weakref.WeakSet()
 
-def empty_state():
+
+def emergency_lock_all(future=False):
     """
-    This is what the bot's state tree looks like.
-    This helper method creates an empty object that is mostly
-    unpopulated.
+    Send `emergency_lock()` to every `Farmbot` in this process. Returns
+    a dict of device ID => label (or `Future`, with `future=True`).
+    A bot that could not be sent the lock does not stop the others; its
+    entry is the exception that was raised instead.
     """
-    return {
-        "configuration": {},
-        "informational_settings": {},
-        "jobs": {},
-        "location_data": {
-            "axis_states": empty_xyz,
-            "load": empty_xyz,
-            "position": empty_xyz,
-            "raw_encoders": empty_xyz,
-            "scaled_encoders": empty_xyz,
-        },
-        "mcu_params": {},
-        "pins": {},
-        "user_env": {}
-    }
+    results = {}
+    for bot in list(_bots):
+        try:
+            results[bot.device_id] = bot.emergency_lock(future)
+        except Exception as error:
+            results[bot.device_id] = error
+    return results
+
+
+def rolling_update(bots, concurrency=5, timeout=None, start=None):
+    """
+    Update FarmBot OS on `bots` with at most `concurrency` updates in
+    progress at a time, so a fleet does not download every update at
+    once. `start(bot)` must return a `JobFuture` and defaults to
+    `bot.update_farmbot_os(future=True)`. A bot's slot is given to the
+    next bot when its job finishes, fails or runs for `timeout` seconds.
+    The connections must be running in other threads.
+
+    Returns a dict of device ID => `Future` of each bot's job result.
+    """
+    if start is None:
+        def start(bot):
+            return bot.update_farmbot_os(future=True)
+    queue = deque(bots)
+    results = OrderedDict([(bot.device_id, Future()) for bot in queue])
+    lock = threading.Lock()
+    # Jobs in progress, and whether a thread is inside `launch()`'s loop.
+    running = [0]
+    launching = [False]
+
+    def finished(_):
+        with lock:
+            running[0] = running[0] - 1
+        launch()
+
+    def launch():
+        # Jobs that finish while starting others (e.g. `start` raised)
+        # free their slot for the loop that is already running, rather
+        # than recursing into a new one.
+        with lock:
+            if launching[0]:
+                return
+            launching[0] = True
+        while True:
+            with lock:
+                if not queue or running[0] >= concurrency:
+                    launching[0] = False
+                    return
+                bot = queue.popleft()
+                running[0] = running[0] + 1
+            run(bot)
+
+    def run(bot):
+        result = results[bot.device_id]
+        result.add_done_callback(finished)
+        try:
+            job = start(bot)
+        except Exception as error:
+            _settle(result, error=error)
+            return
+        if timeout is not None:
+            timer = threading.Timer(timeout, _settle, [result], {
+                "error": TimeoutError("Job did not finish in time")})
+            timer.daemon = True
+            timer.start()
+            result.add_done_callback(lambda _: timer.cancel())
+
+        def done(job):
+            error = job.exception()
+            if error:
+                _settle(result, error=error)
+            else:
+                _settle(result, job.result())
+        job.add_done_callback(done)
+
+    launch()
+    return results
 
 
 class Farmbot():
+    _snapshot = StateSnapshot(0, None)
+
     @classmethod
     def login(cls,
               email,
               password,
-              server="https://my.farm.bot"):
+              server="https://my.farm.bot",
+              options=None):
         """
         We reccomend that users store tokens rather than passwords.
         """
         token = FarmbotToken.download_token(email=email,
                                             password=password,
                                             server=server)
-        return Farmbot(token)
+        return Farmbot(token, options)
 
-    def __init__(self, raw_token):
+    def __init__(self, raw_token, options=None):
+        """
+        `options` is an optional `ConnectionOptions` object.
+        """
         token = FarmbotToken(raw_token)
         self.username = token.bot
         self.password = token.jwt
         self.hostname = token.mqtt
+        self.mqtt_ws = token.mqtt_ws
+        self.vhost = token.vhost
         self.device_id = token.sub
         self._handler = StubHandler()
+        # Defaults for the MoveFutures returned by `move_absolute()` and
+        # `move_relative()` when called with `future=True`.
+        self.move_tolerance = 1.0
+        self.move_timeout = None
+        self.move_stall_timeout = 10.0
+        self.move_max_load = None
+
+        self._snapshot = StateSnapshot(0, empty_state())
+        self._connection = FarmbotConnection(self, options=options)
+        _bots.add(self)
 
-        self._connection = FarmbotConnection(self)
-        self.state = empty_state()
+    @property
+    def state(self):
+        """
+        The most recent state tree. Each status update replaces the tree
+        rather than modifying it, so a tree that has been read is a
+        consistent snapshot. Treat it as read only.
+        """
+        return self._snapshot.state
+
+    @state.setter
+    def state(self, state):
+        # Only the MQTT thread writes the state, so a single attribute
+        # assignment is enough to publish the new snapshot.
+        version = self._snapshot.version + 1
+        self._snapshot = StateSnapshot(version, state)
+
+    def snapshot(self):
+        """
+        Returns the current state tree and its version number as a
+        `StateSnapshot`. Never blocks.
+        """
+        return self._snapshot
 
     def connect(self, handler):
         """
@@ -228,37 +2362,103 @@ class Farmbot():
     def disconnect(self):
         self._connection.stop_connection()
 
+    def track_errors(self, aggregator):
+        """
+        Count this bot's errors in an `ErrorAggregator`, which can be
+        shared by many bots.
+        """
+        self._connection.track_errors(aggregator)
+
+    def track_state(self, table):
+        """
+        Keep this bot's row of a `FleetStateTable` up to date.
+        """
+        table.add(self.device_id)
+        self._connection.state_table = table
+
+    def jobs(self):
+        """
+        Job name => latest `JobProgress` for the jobs (updates, firmware
+        flashing, etc.) reported by the device.
+        """
+        return self._connection.jobs
+
+    def watch_jobs(self, listener):
+        """
+        Call `listener(progress)` with a `JobProgress` whenever a job's
+        progress or status changes.
+        """
+        self._connection.watch_jobs(listener)
+
+    def unwatch_jobs(self, listener):
+        self._connection.unwatch_jobs(listener)
+
+    def _do_job(self, kind, args, name):
+        job = JobFuture(name)
+        rpc = Future()
+        job.track_rpc(rpc)
+        self._connection.watch_jobs(job.update)
+        job.add_done_callback(lambda job: self.unwatch_jobs(job.update))
+        job.label = self._do_cs(kind, args, future=rpc)
+        return job
+
     def position(self):
         """
         Convinence method to return the bot's current location
         as an (x, y, z) tuple.
         """
-        position = self.state["location_data"]["position"]
+        position = self._snapshot.state["location_data"]["position"]
         x = position["x"] or -0.0
         y = position["y"] or -0.0
         z = position["z"] or -0.0
         return (x, y, z)
 
-    def _do_cs(self, kind, args, body=[]):
+    def _do_cs(self, kind, args, body=[], future=None):
         """
         This is a private helper that wraps CeleryScript in
         an `rpc` node and sends it to the device over MQTT.
         """
-        return self._connection.send_rpc({
-            "kind": kind,
-            "args": args,
-            "body": body
-        })
+        rpc = {"kind": kind, "args": args, "body": body}
+        if future is None:
+            return self._connection.send_rpc(rpc)
+        return self._connection.send_rpc(rpc, future)
 
-    def move_absolute(self, x, y, z, speed=100.0):
+    def move_absolute(self, x, y, z, speed=100.0, future=False):
         """
         Move to an absolute XYZ coordinate at a speed percentage (default speed: 100%).
+        Pass `future=True` to get a `MoveFuture` instead of a label.
+        """
+        args = _move_absolute_args(x, y, z, speed)
+        if not future:
+            return self._do_cs("move_absolute", args)
+        return self._do_move("move_absolute", args, (x, y, z))
+
+    def _do_move(self, kind, args, target):
+        move = MoveFuture(target,
+                          tolerance=self.move_tolerance,
+                          timeout=self.move_timeout,
+                          stall_timeout=self.move_stall_timeout,
+                          max_load=self.move_max_load)
+        rpc = Future()
+        move.track_rpc(rpc)
+        move.label = self._do_cs(kind, args, future=rpc)
+        self._connection.watch_move(move)
+        return move
+
+    def wait_until_at(self, x, y, z, tolerance=1.0, timeout=None):
+        """
+        Block until the device reports a position within `tolerance` mm
+        (per axis) of (x, y, z). Returns False if `timeout` seconds pass
+        first. The connection must be running in another thread.
         """
-        return self._do_cs("move_absolute", {
-            "location": {"kind": "coordinate", "args": {"x": x, "y": y, "z": z, }},
-            "speed": speed,
-            "offset": {"kind": "coordinate", "args": zero_xyz}
-        })
+        move = MoveFuture((x, y, z), tolerance=tolerance)
+        self._connection.watch_move(move)
+        try:
+            move.result(timeout)
+            return True
+        except FutureTimeoutError:
+            move.cancel()
+            return False
 
     def send_message(self, msg, type="info"):
         """
@@ -267,12 +2467,20 @@ class Farmbot():
         return self._do_cs("send_message",
                            {"message": msg, "message_type": type, })
 
-    def emergency_lock(self):
+    def emergency_lock(self, future=False):
         """
         Perform an emergency stop, thereby preventing any
         motor movement until `emergency_unlock()` is called.
+        The command is published immediately at QoS 1, ahead of
+        any queued commands. Pass `future=True` to get a `Future`
+        that resolves with the lock latency (in seconds) once the
+        device confirms.
         """
-        return self._do_cs("emergency_lock", {})
+        if not future:
+            return self._connection.send_emergency_lock()
+        result = Future()
+        self._connection.send_emergency_lock(result)
+        return result
 
     def emergency_unlock(self):
         """
@@ -309,13 +2517,24 @@ class Farmbot():
         """
         return self._do_cs("home", {"speed": speed, "axis": axis})
 
-    def move_relative(self, x, y, z, speed=100):
+    def move_relative(self, x, y, z, speed=100, future=False):
         """
         Move to a relative XYZ offset from the device's current
         position at a speed percentage (default speed: 100%).
+        Pass `future=True` to get a `MoveFuture` instead of a label. This
+        needs the current position, so it raises a `ValueError` until a
+        status update with a known position has arrived.
         """
-        return self._do_cs("move_relative",
-                           {"x": x, "y": y, "z": z, "speed": speed})
+        args = _move_relative_args(x, y, z, speed)
+        if not future:
+            return self._do_cs("move_relative", args)
+        location = self._snapshot.state.get("location_data")
+        current = _xyz(location.get("position")
+                       if isinstance(location, dict) else None)
+        if current is None:
+            raise ValueError("The current position is unknown")
+        (cx, cy, cz) = current
+        return self._do_move("move_relative", args, (cx + x, cy + y, cz + z))
 
     def power_off(self):
         """
@@ -330,7 +2549,7 @@ class Farmbot():
         logging in to the device, since the device pushes new states out on
         every update.
         """
-        self._do_cs("read_status", {})
+        return self._do_cs("read_status", {})
 
     def reboot(self):
         """
@@ -370,31 +2589,111 @@ class Farmbot():
         """
         return self._do_cs("toggle_pin", {"pin_number": pin_number})
 
-    def update_farmbot_os(self):
-        return self._do_cs("check_updates", {"package": "farmbot_os"})
+    def update_farmbot_os(self, future=False):
+        """
+        Check for and install a FarmBot OS update. Pass `future=True` to
+        get a `JobFuture` (for the "FBOS_OTA" job) instead of a label.
+        """
+        args = {"package": "farmbot_os"}
+        if future:
+            return self._do_job("check_updates", args, "FBOS_OTA")
+        return self._do_cs("check_updates", args)
 
-    def read_pin(self, pin_number, pin_mode="digital"):
+    def read_pin(self, pin_number, pin_mode="digital", future=False):
         """
-        Read a pin
+        Read a pin. The result appears in the `pins` section of the
+        state tree. Pass `future=True` to get a `Future` (instead of a
+        label) that resolves with the pin's value once the next status
+        update containing it arrives.
         """
-        modes = {"digital": 0, "analog": 1}
-        args = {
-            "label": "pin" + str(pin_number),
-            "pin_mode": modes[pin_mode] or (modes["digital"]),
-            "pin_number": pin_number
-        }
-        return self._do_cs("read_pin", args)
+        args = _read_pin_args(pin_number, pin_mode)
+        if not future:
+            return self._do_cs("read_pin", args)
+        result = Future()
+        rpc = Future()
+        self._connection.watch_pin(pin_number, result, rpc)
+        result.label = self._do_cs("read_pin", args, future=rpc)
+        return result
+
+    def poll_pins(self, pin_numbers, hz=1.0, ticks=None, duration=None,
+                  pin_mode="digital", callback=None, stop=None,
+                  timeout=None):
+        """
+        Sample many pins at a fixed rate. Every tick sends a single
+        `rpc_request` containing one `read_pin` per pin. Runs until
+        `ticks` ticks have been sent, `duration` seconds have passed or
+        the `stop` event (a `threading.Event`) is set, then returns a
+        `PinPollStats` object. `callback(pin_number, value)` is called
+        from the MQTT thread as values arrive.
+
+        Samples that have not arrived `timeout` seconds after their tick
+        (default: 3 ticks, at least 5 seconds) are given up and counted
+        in `errors`, so lost responses are not remembered forever.
+
+        This call blocks, so the connection must be running in another
+        thread (see `example_threads.py`).
+        """
+        stats = PinPollStats(hz)
+        interval = 1.0 / hz
+        if timeout is None:
+            timeout = max(3 * interval, 5.0)
+        # (expires at, rpc, [(pin number, result)]) per tick, oldest first.
+        outstanding = deque()
+        start = time.monotonic()
+        deadline = None if duration is None else start + duration
+        while ticks is None or stats.ticks < ticks:
+            if stop is not None and stop.is_set():
+                break
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                break
+            rpc = Future()
+            nodes = []
+            results = []
+            for pin_number in pin_numbers:
+                result = Future()
+                result.add_done_callback(stats._sampler(pin_number, callback))
+                self._connection.watch_pin(pin_number, result, rpc)
+                results.append((pin_number, result))
+                nodes.append({"kind": "read_pin",
+                              "args": _read_pin_args(pin_number, pin_mode),
+                              "body": []})
+            self._connection.send_rpc(nodes, rpc)
+            outstanding.append((now + timeout, rpc, results))
+            self._expire_ticks(outstanding, now)
+            stats.ticks = stats.ticks + 1
+            next_tick = start + stats.ticks * interval
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                stats.late_ticks = stats.late_ticks + 1
+        stats.elapsed = time.monotonic() - start
+        if outstanding:
+            timer = threading.Timer(timeout, self._expire_ticks,
+                                    [outstanding, float("inf")])
+            timer.daemon = True
+            timer.start()
+        return stats
+
+    def _expire_ticks(self, outstanding, now):
+        while outstanding and outstanding[0][0] <= now:
+            (_, rpc, results) = outstanding.popleft()
+            if not rpc.done():
+                # Fails the tick's results too (see `watch_pin()`).
+                self._connection.pop_pending(rpc.label)
+                _settle(rpc, error=TimeoutError("No response to read_pin"))
+                continue
+            for (pin_number, result) in results:
+                if not result.done():
+                    self._connection.unwatch_pin(pin_number, result)
+                    _settle(result, error=TimeoutError("No pin value"))
 
     def write_pin(self, pin_number, pin_value, pin_mode="digital"):
         """
         Write to a pin
         """
-        modes = {"digital": 0, "analog": 1}
-        args = {
-            "pin_mode": modes[pin_mode] or (modes["digital"]),
-            "pin_number": pin_number,
-            "pin_value": pin_value
-        }
+        args = _write_pin_args(pin_number, pin_value, pin_mode)
         return self._do_cs("write_pin", args)
 
     def set_servo_angle(self, pin_number, angle):
@@ -410,3 +2709,757 @@ class Farmbot():
         """
         return self._do_cs("lua", {"lua": lua_string})
 
+    def run_sequence(self, sequence, lua=True):
+        """
+        Send a recorded `Sequence` to the device as a single message.
+        By default, the routine is compiled to one `lua` call. Pass
+        `lua=False` to send it as one multi-node `rpc_request` instead
+        (conditionals are not supported in that mode).
+        """
+        if lua:
+            return self.lua(sequence.to_lua())
+        return self._connection.send_rpc(sequence.to_celery_script())
+
+
+class ImageCache():
+    """
+    A content-addressed store for downloaded images. Files are named
+    after the SHA-256 of their contents, so identical images are kept
+    once. A small index of source URL => content hash means that each
+    image is downloaded only once.
+    """
+
+    def __init__(self, directory):
+        import os
+        self.directory = directory
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "refs"), exist_ok=True)
+
+    def _ref_path(self, url):
+        import hashlib
+        import os
+        name = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.directory, "refs", name)
+
+    def object_path(self, digest):
+        import os
+        return os.path.join(self.directory, "objects", digest[:2], digest)
+
+    def get(self, url):
+        """
+        Returns the local path of the image downloaded from `url`, or
+        None if it is not cached.
+        """
+        import os
+        try:
+            with open(self._ref_path(url)) as ref:
+                path = self.object_path(ref.read().strip())
+        except FileNotFoundError:
+            return None
+        return path if os.path.exists(path) else None
+
+    def put(self, url, data):
+        """
+        Store the image downloaded from `url` and return its local path.
+        """
+        import hashlib
+        import os
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _write_atomic(path, data)
+        _write_atomic(self._ref_path(url), digest.encode())
+        return path
+
+
+def _write_atomic(path, data):
+    import os
+    tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+    with open(tmp, "wb") as out:
+        out.write(data)
+    os.replace(tmp, path)
+
+
+class _HttpPool():
+    """
+    A minimal HTTP client that keeps one persistent connection per host
+    and thread, so that many downloads from the same host do not pay
+    for a new TCP/TLS handshake each time.
+    """
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def get(self, url, headers=None):
+        import http.client
+        from urllib.parse import urlsplit
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        if not hasattr(self._local, "connections"):
+            self._local.connections = {}
+        connections = self._local.connections
+        # A pooled connection may have been closed by the server, so
+        # retry once on a fresh connection.
+        for attempt in (1, 2):
+            connection = connections.get(key)
+            if connection is None:
+                if parts.scheme == "https":
+                    factory = http.client.HTTPSConnection
+                else:
+                    factory = http.client.HTTPConnection
+                connection = factory(parts.netloc, timeout=self.timeout)
+                connections[key] = connection
+            try:
+                connection.request("GET", path, headers=headers or {})
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                del connections[key]
+                if attempt == 2:
+                    raise
+                continue
+            if response.status != 200:
+                raise OSError("HTTP %d for %s" % (response.status, url))
+            return data
+
+
+CapturedImage = namedtuple("CapturedImage", ["point", "image", "path"])
+CapturedImage.__doc__ = """
+A photo taken by `CapturePipeline`: the (x, y, z) `point`, the API's
+`image` record and the `path` of the downloaded file.
+"""
+
+
+class CapturePipeline():
+    """
+    Takes a photo at each point of a scan and downloads the images that
+    the device uploads to the web API.
+
+    Uploaded images are matched to the point they were taken at using
+    their `meta` coordinates. They are discovered through `sync`
+    messages, or by polling `/api/images` every `poll_interval` seconds.
+    Downloads run on `workers` threads through a pooled HTTP client
+    into an `ImageCache` at `cache_dir`, so that motion, capture and
+    download overlap.
+
+        pipeline = CapturePipeline(bot, "photos")
+        for capture in pipeline.scan([(0, 0, 0), (100, 0, 0)]):
+            print(capture.result(timeout=300).path)
+        pipeline.close()
+
+    `scan()` blocks, so the connection must be running in another thread.
+
+    Images that were already on the account when the pipeline was
+    created are never matched (their IDs are fetched from the API by
+    the constructor, unless `ignore_existing` is False), and neither are
+    images without coordinates.
+    """
+
+    def __init__(self,
+                 bot,
+                 cache_dir,
+                 server="https://my.farm.bot",
+                 workers=4,
+                 tolerance=5.0,
+                 poll_interval=None,
+                 ignore_existing=True):
+        from concurrent.futures import ThreadPoolExecutor
+        self.bot = bot
+        self.cache = ImageCache(cache_dir)
+        self.server = server
+        self.tolerance = tolerance
+        self.poll_interval = poll_interval
+        # Futures for photos that have not been matched to an image yet,
+        # oldest first. Copy-on-write, like the connection's tables.
+        self.captures = []
+        self._seen = set()
+        self._lock = threading.Lock()
+        self._http = _HttpPool()
+        self._executor = ThreadPoolExecutor(workers)
+        self._closed = threading.Event()
+        if ignore_existing:
+            self._seen.update([image.get("id") for image in self.images()
+                               if isinstance(image, dict)])
+        bot._connection.watch_sync(self.handle_sync)
+        if poll_interval:
+            self._poller = threading.Thread(target=self._poll_loop,
+                                            daemon=True)
+            self._poller.start()
+
+    def scan(self, points, speed=100.0, timeout=60.0):
+        """
+        Move to each (x, y, z) point and take a photo. Returns one
+        `Future` per point, which resolves with a `CapturedImage` once
+        the image is downloaded. A point whose move or photo takes longer
+        than `timeout` seconds fails with a `TimeoutError`, and the scan
+        moves on to the next point.
+        """
+        results = []
+        for (x, y, z) in points:
+            move = self.bot.move_absolute(x, y, z, speed, future=True)
+            try:
+                error = move.exception(timeout)
+            except FutureTimeoutError:
+                move.cancel()
+                self.bot._connection.pop_pending(move.label)
+                error = TimeoutError("Move did not complete")
+            if error:
+                result = Future()
+                result.point = (x, y, z)
+                _settle(result, error=error)
+                results.append(result)
+                continue
+            results.append(self.capture((x, y, z), timeout))
+        return results
+
+    def capture(self, point, timeout=60.0):
+        """
+        Take a photo at the current location, which should be `point`.
+        Blocks (for up to `timeout` seconds) until the device has taken
+        the photo, not until the image is downloaded.
+        """
+        result = Future()
+        result.point = point
+        with self._lock:
+            self.captures = self.captures + [result]
+        photo = Future()
+        result.label = self.bot._do_cs("take_photo", {}, future=photo)
+        try:
+            error = photo.exception(timeout)
+        except FutureTimeoutError:
+            self.bot._connection.pop_pending(result.label)
+            error = TimeoutError("Photo was not taken")
+        if error:
+            self._forget(result)
+            _settle(result, error=error)
+        return result
+
+    def _forget(self, capture):
+        with self._lock:
+            self.captures = [c for c in self.captures if c is not capture]
+
+    def handle_sync(self, kind, id, body):
+        if kind == "Image" and isinstance(body, dict):
+            self.match(body)
+
+    def match(self, image):
+        """
+        Match an image record from the API to the oldest photo taken
+        within `tolerance` of its coordinates and start downloading it.
+        """
+        if not isinstance(image.get("attachment_url"), str) or \
+                not isinstance(image.get("id"), (int, str)):
+            return
+        if "attachment_processed_at" in image and \
+                not image["attachment_processed_at"]:
+            return
+        meta = image.get("meta")
+        if not isinstance(meta, dict):
+            meta = {}
+        with self._lock:
+            if image.get("id") in self._seen:
+                return
+            capture = None
+            for candidate in self.captures:
+                if self._near(candidate.point, meta):
+                    capture = candidate
+                    break
+            if capture is None:
+                return
+            self._seen.add(image.get("id"))
+            self.captures = [c for c in self.captures if c is not capture]
+        download = self._executor.submit(self.download, image)
+
+        def done(download):
+            error = download.exception()
+            if error:
+                _settle(capture, error=error)
+            else:
+                path = download.result()
+                _settle(capture, CapturedImage(capture.point, image, path))
+        download.add_done_callback(done)
+
+    def _near(self, point, meta):
+        for (axis, value) in zip("xyz", point):
+            coordinate = meta.get(axis)
+            if not isinstance(coordinate, (int, float)) or \
+                    isinstance(coordinate, bool):
+                # Z is optional; images without X and Y can't be placed.
+                if axis == "z":
+                    continue
+                return False
+            if abs(coordinate - value) > self.tolerance:
+                return False
+        return True
+
+    def download(self, image):
+        """
+        Download an image (unless it is cached) and return its path.
+        """
+        from urllib.parse import urljoin, urlsplit
+        url = urljoin(self.server, image["attachment_url"])
+        path = self.cache.get(url)
+        if path:
+            return path
+        headers = {}
+        # Only send the token to the API itself, not to file storage.
+        (scheme, netloc) = urlsplit(url)[:2]
+        server = urlsplit(self.server)
+        if (scheme.lower(), netloc.lower()) == \
+                (server.scheme.lower(), server.netloc.lower()):
+            headers["Authorization"] = "Bearer " + self.bot.password
+        return self.cache.put(url, self._http.get(url, headers))
+
+    def poll(self):
+        """
+        Fetch `/api/images` once and match any new images.
+        """
+        for image in self.images():
+            if isinstance(image, dict):
+                self.match(image)
+
+    def images(self):
+        """
+        Every image record on the account, from `/api/images`.
+        """
+        headers = {"Authorization": "Bearer " + self.bot.password}
+        data = self._http.get(self.server + "/api/images", headers)
+        images = json.loads(data)
+        return images if isinstance(images, list) else []
+
+    def _poll_loop(self):
+        while not self._closed.wait(self.poll_interval):
+            if not self.captures:
+                continue
+            try:
+                self.poll()
+            except (OSError, ValueError):
+                # Try again on the next tick.
+                pass
+
+    def close(self):
+        """
+        Stop listening for images and wait for running downloads.
+        """
+        self._closed.set()
+        self.bot._connection.unwatch_sync(self.handle_sync)
+        self._executor.shutdown(wait=True)
+
+
+def _shard_for(device_id, shards):
+    import zlib
+    return zlib.crc32(str(device_id).encode()) % shards
+
+
+def _fleet_summary(bot):
+    """
+    The parts of a bot's state that `FleetRunner` reports to the parent.
+    """
+    snapshot = bot.snapshot()
+    info = snapshot.state.get("informational_settings")
+    if not isinstance(info, dict):
+        info = {}
+    location = snapshot.state.get("location_data")
+    if not isinstance(location, dict):
+        location = {}
+    return {"version": snapshot.version,
+            "position": _xyz(location.get("position")),
+            "busy": info.get("busy"),
+            "locked": info.get("locked")}
+
+
+class _FleetHandler():
+    """
+    Wraps a user's handler inside a `FleetRunner` worker, counting the
+    events that reach it. All bots of a worker share `metrics` and run
+    their handlers on their own MQTT threads, hence `lock`.
+    """
+
+    def __init__(self, handler, metrics, lock):
+        self.handler = handler
+        self.metrics = metrics
+        self.lock = lock
+
+    def _count(self, name, started):
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.metrics[name] = self.metrics[name] + 1
+            self.metrics["handler_seconds"] = (
+                self.metrics["handler_seconds"] + elapsed)
+
+    def on_connect(self, bot, client):
+        started = time.perf_counter()
+        self.handler.on_connect(bot, client)
+        self._count("connects", started)
+
+    def on_change(self, bot, state):
+        started = time.perf_counter()
+        self.handler.on_change(bot, state)
+        self._count("changes", started)
+
+    def on_log(self, bot, log):
+        started = time.perf_counter()
+        self.handler.on_log(bot, log)
+        self._count("logs", started)
+
+    def on_error(self, bot, response):
+        started = time.perf_counter()
+        self.handler.on_error(bot, response)
+        self._count("errors", started)
+
+    def on_response(self, bot, response):
+        started = time.perf_counter()
+        self.handler.on_response(bot, response)
+        self._count("responses", started)
+
+
+def _fleet_worker(shard, raw_tokens, handler_class, handler_args, options,
+                  pipe, report_interval):
+    """
+    Body of a `FleetRunner` worker process.
+    """
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            pipe.send(message)
+
+    bots = {}
+    metrics = dict([(name, 0) for name in ("connects", "changes", "logs",
+                                           "errors", "responses")])
+    metrics["handler_seconds"] = 0.0
+    metrics_lock = threading.Lock()
+    for raw_token in raw_tokens:
+        bot = Farmbot(raw_token, options)
+        handler = _FleetHandler(handler_class(*handler_args), metrics,
+                                metrics_lock)
+        bots[bot.device_id] = bot
+        threading.Thread(target=bot.connect, args=[handler],
+                         daemon=True).start()
+
+    def report():
+        summaries = dict([(device_id, _fleet_summary(bot))
+                          for (device_id, bot) in bots.items()])
+        with metrics_lock:
+            snapshot = dict(metrics)
+        send(("report", shard, summaries, snapshot))
+
+    stop = threading.Event()
+
+    def report_loop():
+        while not stop.wait(report_interval):
+            report()
+    threading.Thread(target=report_loop, daemon=True).start()
+    while True:
+        try:
+            message = pipe.recv()
+        except EOFError:
+            break
+        if message[0] == "stop":
+            break
+        (_, request_id, device_id, method, args, kwargs) = message
+        try:
+            result = getattr(bots[device_id], method)(*args, **kwargs)
+            send(("result", request_id, result, None))
+        except Exception as error:
+            send(("result", request_id, None, repr(error)))
+    stop.set()
+    for bot in bots.values():
+        bot.disconnect()
+    report()
+    send(("stopped", shard, None, None))
+    pipe.close()
+
+
+class FleetRunner():
+    """
+    Runs many bots across `processes` worker processes, so that CPU
+    heavy handlers are not limited to one core by the GIL.
+
+    Bots are sharded by device ID. Each worker connects its bots and
+    runs `handler_class(*handler_args)` for each of them, exactly as
+    `Farmbot.connect()` would. Every `report_interval` seconds, workers
+    send a summary of each bot's state (see `snapshots()`) and their
+    handler metrics (see `metrics()`) to the parent over a pipe.
+    Commands are routed to the right worker with `call()`.
+
+        runner = FleetRunner(tokens, MyHandler, processes=4)
+        runner.start()
+        runner.call(device_id, "move_absolute", 100, 0, 0).result()
+        print(runner.snapshots()[device_id]["position"])
+        runner.stop()
+
+    The handler class, its arguments and the options must be picklable,
+    and so must the return values of commands sent with `call()`. Each
+    bot keeps its own MQTT client (the broker authenticates each device
+    separately), but all of a worker's bots share its process.
+    """
+
+    def __init__(self,
+                 raw_tokens,
+                 handler_class,
+                 handler_args=(),
+                 processes=None,
+                 options=None,
+                 report_interval=1.0,
+                 start_method=None):
+        import multiprocessing
+        self.processes = processes or multiprocessing.cpu_count()
+        self.handler_class = handler_class
+        self.handler_args = handler_args
+        self.options = options
+        self.report_interval = report_interval
+        self._context = multiprocessing.get_context(start_method)
+        self.shards = [[] for _ in range(self.processes)]
+        self.device_shards = {}
+        for raw_token in raw_tokens:
+            device_id = FarmbotToken(raw_token).sub
+            shard = _shard_for(device_id, self.processes)
+            self.shards[shard].append(raw_token)
+            self.device_shards[device_id] = shard
+        self._snapshots = {}
+        self._metrics = {}
+        # Request ID => (shard, future), until the worker answers.
+        self._requests = {}
+        self._request_ids = 0
+        self._lock = threading.Lock()
+        # Shards whose worker has stopped or gone away.
+        self._stopped = set()
+        self._pipes = []
+        # One per pipe, so a full pipe only blocks callers of its shard.
+        self._send_locks = []
+        self._workers = []
+        self._readers = []
+
+    def start(self):
+        for (shard, raw_tokens) in enumerate(self.shards):
+            (parent, child) = self._context.Pipe()
+            worker = self._context.Process(
+                target=_fleet_worker,
+                args=(shard, raw_tokens, self.handler_class,
+                      self.handler_args, self.options, child,
+                      self.report_interval),
+                daemon=True)
+            worker.start()
+            child.close()
+            reader = threading.Thread(target=self._read,
+                                      args=(shard, parent), daemon=True)
+            self._pipes.append(parent)
+            self._send_locks.append(threading.Lock())
+            reader.start()
+            self._workers.append(worker)
+            self._readers.append(reader)
+
+    def _read(self, shard, pipe):
+        while True:
+            try:
+                (kind, key, value, extra) = pipe.recv()
+            except (EOFError, OSError):
+                break
+            if kind == "report":
+                with self._lock:
+                    snapshots = dict(self._snapshots)
+                    snapshots.update(value)
+                    self._snapshots = snapshots
+                    metrics = dict(self._metrics)
+                    metrics[key] = extra
+                    self._metrics = metrics
+            elif kind == "result":
+                with self._lock:
+                    (_, future) = self._requests.pop(key, (None, None))
+                if future is None:
+                    continue
+                if extra is None:
+                    _settle(future, value)
+                else:
+                    _settle(future, error=RuntimeError(extra))
+            elif kind == "stopped":
+                break
+        self._fail_shard(shard)
+
+    def _fail_shard(self, shard):
+        """
+        Fail the futures of every unanswered `call()` to `shard`, whose
+        worker will never answer them.
+        """
+        with self._lock:
+            self._stopped.add(shard)
+            lost = [(request_id, future)
+                    for (request_id, (other, future)) in self._requests.items()
+                    if other == shard]
+            for (request_id, _) in lost:
+                del self._requests[request_id]
+        for (_, future) in lost:
+            _settle(future, error=RuntimeError("Worker %d stopped" % shard))
+
+    def call(self, device_id, method, *args, **kwargs):
+        """
+        Call `method` on the bot with `device_id` in its worker process.
+        Returns a `Future` for the method's return value (a label for
+        most commands).
+        """
+        shard = self.device_shards[device_id]
+        future = Future()
+        with self._lock:
+            if shard in self._stopped:
+                _settle(future,
+                        error=RuntimeError("Worker %d stopped" % shard))
+                return future
+            self._request_ids = self._request_ids + 1
+            request_id = self._request_ids
+            self._requests[request_id] = (shard, future)
+        try:
+            with self._send_locks[shard]:
+                self._pipes[shard].send(("call", request_id, device_id,
+                                         method, args, kwargs))
+        except Exception as error:
+            with self._lock:
+                self._requests.pop(request_id, None)
+            _settle(future, error=error)
+        return future
+
+    def snapshots(self):
+        """
+        Device ID => latest summary: {"version", "position", "busy",
+        "locked"}. "position" is None until all of X, Y and Z are known.
+        """
+        return self._snapshots
+
+    def metrics(self):
+        """
+        Shard number => handler event counts and time spent in handlers.
+        """
+        return self._metrics
+
+    def stop(self, timeout=10):
+        for (pipe, send_lock) in zip(self._pipes, self._send_locks):
+            try:
+                with send_lock:
+                    pipe.send(("stop",))
+            except OSError:
+                pass  # The worker is already gone.
+        for reader in self._readers:
+            reader.join(timeout)
+        for worker in self._workers:
+            worker.join(timeout)
+        for pipe in self._pipes:
+            pipe.close()
+
+
+_cli_commands = (
+    "emergency_lock", "emergency_unlock", "factory_reset", "find_home",
+    "find_length", "flash_farmduino", "go_to_home", "lua",
+    "move_absolute", "move_relative", "power_off", "read_pin",
+    "read_status", "reboot", "reboot_farmduino", "send_message",
+    "set_servo_angle", "sync", "take_photo", "toggle_pin",
+    "update_farmbot_os", "write_pin",
+)
+
+
+class _CommandHandler(StubHandler):
+    """
+    Sends a single command once connected and disconnects as soon as
+    the device answers it.
+    """
+
+    def __init__(self, command, args, wait=True):
+        self.command = command
+        self.args = args
+        self.wait = wait
+        self.label = None
+        self.exit_code = 2
+
+    def on_connect(self, bot, client):
+        self.label = getattr(bot, self.command)(*self.args)
+        if not self.wait:
+            # The DISCONNECT packet is queued behind the command.
+            self.exit_code = 0
+            bot.disconnect()
+
+    def on_response(self, bot, response):
+        if response.id == self.label:
+            self.exit_code = 0
+            bot.disconnect()
+
+    def on_error(self, bot, response):
+        if response.id == self.label:
+            print("Error: " + "; ".join(response.errors))
+            self.exit_code = 1
+            bot.disconnect()
+
+
+def _cli_arg(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def main(argv=None):
+    """
+    Entry point for `python -m farmbot`. Sends one command to the
+    device and exits as soon as it is acknowledged. Exits with status 1
+    if the device reports an error and 2 on timeout.
+
+        python -m farmbot --token token.json move_absolute 10 20 0
+    """
+    import argparse
+    import os
+    import sys
+    parser = argparse.ArgumentParser(
+        prog="python -m farmbot",
+        description="Send a single command to a FarmBot.")
+    parser.add_argument("--token",
+                        help="File containing a token. Defaults to the "
+                             "FARMBOT_TOKEN environment variable.")
+    parser.add_argument("--email")
+    parser.add_argument("--password")
+    parser.add_argument("--server", default="https://my.farm.bot")
+    parser.add_argument("--timeout", type=float, default=30.0,
+                        help="Seconds to wait for a response.")
+    parser.add_argument("--tls", action="store_true")
+    parser.add_argument("--transport", choices=("tcp", "websockets"),
+                        default="tcp")
+    parser.add_argument("--no-wait", action="store_true",
+                        help="Exit once the command is sent, without "
+                             "waiting for a response.")
+    parser.add_argument("command", choices=_cli_commands)
+    parser.add_argument("args", nargs="*", type=_cli_arg,
+                        help="Command arguments (parsed as JSON when "
+                             "possible).")
+    opts = parser.parse_args(argv)
+    options = ConnectionOptions.publish_only(acks=not opts.no_wait,
+                                             transport=opts.transport,
+                                             tls=opts.tls)
+    if opts.token:
+        with open(opts.token) as token_file:
+            raw_token = token_file.read()
+    elif opts.email:
+        raw_token = FarmbotToken.download_token(opts.email,
+                                                opts.password,
+                                                opts.server)
+    elif os.environ.get("FARMBOT_TOKEN"):
+        raw_token = os.environ["FARMBOT_TOKEN"]
+    else:
+        parser.error("A token (--token or FARMBOT_TOKEN) or --email and "
+                     "--password are required.")
+    bot = Farmbot(raw_token, options)
+    handler = _CommandHandler(opts.command, opts.args, not opts.no_wait)
+    timer = threading.Timer(opts.timeout, bot.disconnect)
+    timer.daemon = True
+    timer.start()
+    try:
+        bot.connect(handler)
+    finally:
+        timer.cancel()
+    if handler.exit_code == 2:
+        print("Timed out waiting for a response.", file=sys.stderr)
+    return handler.exit_code
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
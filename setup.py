@@ -25,7 +25,8 @@ setup(
     ],
     extras_require={
         "dev": [
-            "pytest>=6.2"
+            "pytest>=6.2",
+            "hypothesis>=6"
         ]
     },
     url="https://github.com/farmbot-labs/farmbot-py",